@@ -0,0 +1,319 @@
+"""Local stand-ins for a MyTardis TastyPie API and an SFTP staging host
+
+Both run in background threads of the benchmark process and accept an
+injected latency, the staging host also a bandwidth limit.
+"""
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import json
+import os
+import paramiko
+import pathlib
+import select
+import socket
+import threading
+import time
+import urllib.parse
+
+# Query filters understood by FakeTardis, mapped to object fields
+FILTERS = {
+    'name': 'name',
+    'title': 'title',
+    'description': 'description',
+    'filename': 'filename',
+    'pluginId': 'pluginId',
+    'entityId': 'entityId',
+    'object_id': 'object_id',
+    'dataset__id': 'dataset_id',
+    'experiments__id': 'experiment_id'
+}
+
+
+def parse_multipart(content_type, body):
+    """Parts of a multipart/form-data body by field name"""
+    message = BytesParser(policy=HTTP).parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+    return {x.get_param('name', header='content-disposition'): x.get_payload(decode=True) for x in message.iter_parts()}
+
+
+class FakeTardis:
+    """In-memory TastyPie API with filters, paging, multipart uploads and verify
+    :param latency: seconds added to every request
+    :param storagebox: path of the single storage box named default
+    """
+    def __init__(self, latency=0.0, storagebox='/tmp'):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.objects = {'storagebox': [{'id': 1, 'name': 'default', 'options': [{'value': str(storagebox)}]}]}
+        self.requests = {'GET': 0, 'POST': 0}
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.httpd.server_address
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self, method):
+        with self.lock:
+            self.requests[method] += 1
+        time.sleep(self.latency)
+
+    def list(self, model, query):
+        objects = self.objects.get(model, [])
+        for key, value in query.items():
+            if key in FILTERS:
+                objects = [x for x in objects if str(x.get(FILTERS[key])) == value]
+        return objects
+
+    def create(self, model, data, attached=None):
+        with self.lock:
+            obj = dict(data)
+            obj['id'] = len(self.objects.setdefault(model, [])) + 1
+            if model == 'dataset':
+                obj['experiment_id'] = int(data['experiments'][0].split('/')[-2])
+            if model == 'dataset_file':
+                obj['dataset_id'] = int(data['dataset'].split('/')[-2])
+                obj.setdefault('directory', None)
+                obj['replicas'] = [dict(data['replicas'][0])] if data.get('replicas') else [{'verified': False}]
+                if attached is not None:
+                    obj['replicas'][0]['verified'] = len(attached) == int(data['size'])
+            self.objects[model].append(obj)
+            return obj
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, code, obj):
+                body = json.dumps(obj).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                fake.count('GET')
+                url = urllib.parse.urlparse(self.path)
+                parts = url.path.strip('/').split('/')
+                model = parts[2]
+                query = dict(urllib.parse.parse_qsl(url.query))
+                if len(parts) > 4 and parts[4] == 'verify':
+                    for obj in fake.objects.get(model, []):
+                        if str(obj['id']) == parts[3]:
+                            obj['replicas'][0]['verified'] = True
+                    return self.reply(200, {})
+                objects = fake.list(model, query)
+                limit = int(query.get('limit', 20))
+                offset = int(query.get('offset', 0))
+                next_page = None
+                if offset + limit < len(objects):
+                    next_page = f'{url.path}?{urllib.parse.urlencode({**query, "offset": offset + limit})}'
+                meta = {'limit': limit, 'offset': offset, 'total_count': len(objects), 'next': next_page}
+                self.reply(200, {'meta': meta, 'objects': objects[offset:offset + limit]})
+
+            def do_POST(self):
+                fake.count('POST')
+                model = self.path.split('/')[3]
+                length = int(self.headers.get('Content-Length', 0))
+                content_type = self.headers.get('Content-Type', '')
+                body = self.rfile.read(length)
+                attached = None
+                if 'multipart' in content_type:
+                    parts = parse_multipart(content_type, body)
+                    data = json.loads(parts['json_data'])
+                    attached = parts['attached_file']
+                else:
+                    data = json.loads(body)
+                self.reply(201, fake.create(model, data, attached))
+
+        return Handler
+
+
+class Throttle:
+    """Shared bandwidth limit in bytes per second, unlimited if None"""
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.available = time.monotonic()
+
+    def wait(self, nbytes):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.available)
+            self.available = start + nbytes / self.rate
+        time.sleep(max(0.0, self.available - now))
+
+
+class FakeStaging:
+    """SFTP and direct-tcpip SSH server writing under the real filesystem
+    Any user and key are accepted.
+    :param latency: seconds added to every SFTP request
+    :param bandwidth: write limit in bytes per second over all connections
+    """
+    def __init__(self, latency=0.0, bandwidth=None):
+        self.latency = latency
+        self.throttle = Throttle(bandwidth)
+        self.hostkey = paramiko.RSAKey.generate(2048)
+        self.stats = {'connections': 0, 'channels': 0, 'forwards': 0, 'bytes': 0}
+        self.lock = threading.Lock()
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(64)
+
+    @property
+    def port(self):
+        return self.listener.getsockname()[1]
+
+    def add(self, stat, value=1):
+        with self.lock:
+            self.stats[stat] += value
+
+    def start(self):
+        threading.Thread(target=self.accept, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.listener.close()
+
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(client,), daemon=True).start()
+
+    def serve(self, client):
+        self.add('connections')
+        transport = paramiko.Transport(client)
+        transport.add_server_key(self.hostkey)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, self.sftp_interface())
+        server = self.server_interface()
+        transport.start_server(server=server)
+        # Accepted SFTP session channels close when garbage collected, they are kept until closed
+        sessions = []
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is None:
+                continue
+            if channel.get_id() in server.forwards:
+                destination = server.forwards.pop(channel.get_id())
+                threading.Thread(target=self.forward, args=(channel, destination), daemon=True).start()
+            else:
+                sessions = [x for x in sessions if not x.closed] + [channel]
+
+    @staticmethod
+    def forward(channel, destination):
+        sock = socket.create_connection(destination)
+        try:
+            while True:
+                readable, _, _ = select.select([channel, sock], [], [])
+                if channel in readable:
+                    data = channel.recv(65536)
+                    if not data:
+                        break
+                    sock.sendall(data)
+                if sock in readable:
+                    data = sock.recv(65536)
+                    if not data:
+                        break
+                    channel.sendall(data)
+        except OSError:
+            pass
+        finally:
+            channel.close()
+            sock.close()
+
+    def server_interface(self):
+        fake = self
+
+        class Server(paramiko.ServerInterface):
+            def __init__(self):
+                self.forwards = {}
+
+            def check_auth_publickey(self, username, key):
+                return paramiko.AUTH_SUCCESSFUL
+
+            def get_allowed_auths(self, username):
+                return 'publickey'
+
+            def check_channel_request(self, kind, chanid):
+                fake.add('channels')
+                return paramiko.OPEN_SUCCEEDED
+
+            def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+                fake.add('forwards')
+                self.forwards[chanid] = destination
+                return paramiko.OPEN_SUCCEEDED
+
+        return Server()
+
+    def sftp_interface(self):
+        fake = self
+
+        class Handle(paramiko.SFTPHandle):
+            def write(self, offset, data):
+                time.sleep(fake.latency)
+                fake.throttle.wait(len(data))
+                fake.add('bytes', len(data))
+                return paramiko.SFTPHandle.write(self, offset, data)
+
+            def stat(self):
+                time.sleep(fake.latency)
+                return paramiko.SFTPAttributes.from_stat(os.fstat(self.writefile.fileno()))
+
+        class Interface(paramiko.SFTPServerInterface):
+            def open(self, path, flags, attr):
+                time.sleep(fake.latency)
+                path = pathlib.Path(path)
+                try:
+                    if flags & os.O_TRUNC or not path.exists():
+                        path.write_bytes(b'')
+                    fileobj = open(path, 'r+b')
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+                handle = Handle(flags)
+                handle.filename = str(path)
+                handle.readfile = fileobj
+                handle.writefile = fileobj
+                return handle
+
+            def stat(self, path):
+                time.sleep(fake.latency)
+                try:
+                    return paramiko.SFTPAttributes.from_stat(os.stat(path))
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+
+            lstat = stat
+
+            def mkdir(self, path, attr):
+                time.sleep(fake.latency)
+                try:
+                    os.mkdir(path)
+                    return paramiko.SFTP_OK
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+
+            def chattr(self, path, attr):
+                return paramiko.SFTP_OK
+
+        return Interface
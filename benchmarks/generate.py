@@ -0,0 +1,171 @@
+"""Synthetic dicom sessions for benchmarks
+
+python -m benchmarks.generate {output-directory} --instruments SIEMENS:TrioTim:Prisma --series 10 --instances 100
+
+Also writes {output-directory}.ini routing the generated instruments.
+"""
+from pydicom.dataset import Dataset
+from pydicom.dataset import FileDataset
+from pydicom.uid import ExplicitVRLittleEndian
+from pydicom.uid import generate_uid
+import argparse
+import configparser
+import json
+import os
+import pathlib
+import random
+
+# Default instrument as manufacturer:station:instrument name
+DEFAULT_INSTRUMENTS = ['SIEMENS:TrioTim:Prisma']
+
+
+def parse_instruments(instruments):
+    """[(manufacturer, station, name)] from manufacturer:station:name strings"""
+    parsed = []
+    for instrument in instruments:
+        manufacturer, station, name = instrument.split(':')
+        parsed.append((manufacturer, station, name))
+    return parsed
+
+
+def make_dicom(path, instrument, study, series, instance, size, rng):
+    """Writes one MR image of size x size 16 bit random pixels"""
+    manufacturer, station, _ = instrument
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dcm = FileDataset(str(path), {}, file_meta=meta, preamble=b'\0' * 128)
+    dcm.is_little_endian = True
+    dcm.is_implicit_VR = False
+    dcm.SOPClassUID = meta.MediaStorageSOPClassUID
+    dcm.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    dcm.Manufacturer = manufacturer
+    dcm.StationName = station
+    dcm.PatientName = f'Subject^{study["subject"]}'
+    dcm.PatientID = study['subject']
+    dcm.ReferringPhysicianName = study['project']
+    dcm.StudyInstanceUID = study['uid']
+    dcm.StudyDate = '20200101'
+    dcm.StudyTime = f'{10 + study["index"] % 10:02}1010.000'
+    dcm.StudyDescription = study['description']
+    dcm.SeriesInstanceUID = series['uid']
+    dcm.SeriesDate = dcm.StudyDate
+    dcm.SeriesTime = dcm.StudyTime
+    dcm.SeriesNumber = series['number']
+    dcm.SeriesDescription = series['description']
+    dcm.InstanceNumber = instance
+    dcm.ImagesInAcquisition = series['instances']
+    dcm.Rows = size
+    dcm.Columns = size
+    dcm.BitsAllocated = 16
+    dcm.BitsStored = 16
+    dcm.HighBit = 15
+    dcm.PixelRepresentation = 0
+    dcm.SamplesPerPixel = 1
+    dcm.PhotometricInterpretation = 'MONOCHROME2'
+    dcm.PixelData = rng.getrandbits(size * size * 16).to_bytes(size * size * 2, 'little')
+    dcm.save_as(str(path), write_like_original=False)
+
+
+def generate(outdir, instruments=DEFAULT_INSTRUMENTS, studies=1, series=4, instances=50, size=256, invalid=0.0,
+             seed=0):
+    """Writes a session of studies x series x instances dicoms per instrument
+    :param size: rows and columns of every image
+    :param invalid: ratio of extra non dicom files
+    :return: dict of the session layout, file and byte counts
+    """
+    outdir = pathlib.Path(outdir)
+    rng = random.Random(seed)
+    instruments = parse_instruments(instruments)
+    nfiles = 0
+    ninvalid = 0
+    nbytes = 0
+    for instrument in instruments:
+        for istudy in range(studies):
+            study = {
+                'index': istudy,
+                'uid': generate_uid(),
+                'subject': f'SUBJ{istudy:04}',
+                'project': f'bench{istudy % 2}',
+                'description': 'benchmark'
+            }
+            for iseries in range(1, series + 1):
+                series_info = {
+                    'uid': generate_uid(),
+                    'number': iseries,
+                    'description': f'series{iseries}',
+                    'instances': instances
+                }
+                seriesdir = outdir/instrument[2]/study['subject']/f'{iseries:03}'
+                seriesdir.mkdir(parents=True, exist_ok=True)
+                for instance in range(1, instances + 1):
+                    path = seriesdir/f'{instance:05}.dcm'
+                    make_dicom(path, instrument, study, series_info, instance, size, rng)
+                    nfiles += 1
+                    nbytes += os.path.getsize(path)
+                    if rng.random() < invalid:
+                        (seriesdir/f'{instance:05}.txt').write_text('not a dicom')
+                        ninvalid += 1
+    return {
+        'instruments': [':'.join(x) for x in instruments],
+        'studies': studies,
+        'series': series,
+        'instances': instances,
+        'size': size,
+        'dicoms': nfiles,
+        'invalid': ninvalid,
+        'bytes': nbytes
+    }
+
+
+def write_config(path, instruments=DEFAULT_INSTRUMENTS, url='http://127.0.0.1:8000', staging=None, client=None):
+    """Writes an imagetrove.ini routing the generated instruments
+    :param staging: dict of [Staging] options, direct uploads if None
+    :param client: dict of extra [Client] options
+    """
+    cfg = configparser.ConfigParser()
+    cfg.optionxform = str
+    cfg['Server'] = {'User': 'bench', 'ApiKey': 'bench', 'Url': url, 'Institution': 'Benchmark'}
+    cfg['Client'] = {'cache': 'False', **(client if client else {})}
+    if staging:
+        cfg['Staging'] = staging
+    instruments = parse_instruments(instruments)
+    cfg['Instrument Mapping'] = {f'{x[0]}-{x[1]}': x[2] for x in instruments}
+    for _, _, name in instruments:
+        cfg[name] = {
+            'experiment-tag': 'ReferringPhysicianName',
+            'dataset-tag': 'PatientID',
+            'facility-name': f'{name}Facility',
+            'storagebox': 'default'
+        }
+    with open(path, 'w') as config:
+        cfg.write(config)
+    return path
+
+
+def add_arguments(parser):
+    parser.add_argument('--instruments', nargs='+', default=DEFAULT_INSTRUMENTS,
+                        help='instruments as manufacturer:station:name')
+    parser.add_argument('--studies', type=int, default=1, help='studies per instrument')
+    parser.add_argument('--series', type=int, default=4, help='series per study')
+    parser.add_argument('--instances', type=int, default=50, help='dicoms per series')
+    parser.add_argument('--size', type=int, default=256, help='rows and columns of every image')
+    parser.add_argument('--invalid', type=float, default=0.0, help='ratio of extra non dicom files')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the pixel data')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('outdir', help='Output directory')
+    add_arguments(parser)
+    args = parser.parse_args()
+    session = generate(args.outdir, args.instruments, args.studies, args.series, args.instances, args.size,
+                       args.invalid, args.seed)
+    # Next to the session, so it is not scanned as an invalid file
+    write_config(pathlib.Path(f'{args.outdir}.ini'), args.instruments)
+    print(json.dumps(session, indent=2))
+
+
+if __name__ == '__main__':
+    main()
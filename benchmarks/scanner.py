@@ -0,0 +1,71 @@
+"""Benchmark of the header-only scanner against a full header parse
+
+python -m benchmarks.scanner {input-directory} --config {config}
+"""
+from imgtr.dicom import Routing
+from imgtr.dicom import read_header
+from imgtr.dicom import scan_tags
+from imgtr.dicom import scanner
+import argparse
+import configparser
+import json
+import pathlib
+import pydicom
+import time
+
+
+def full_header(infile):
+    """Header parse the scanner used before read_header"""
+    with pydicom.dcmread(str(infile), stop_before_pixels=True) as dcm:
+        return dcm
+
+
+def timed(func, infiles):
+    """Runs func over infiles
+    :return: (seconds, number of invalid files)
+    """
+    invalid = 0
+    start = time.perf_counter()
+    for infile in infiles:
+        try:
+            func(infile)
+        except pydicom.errors.InvalidDicomError:
+            invalid += 1
+    return time.perf_counter() - start, invalid
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('indir', help='Input directory')
+    parser.add_argument('--config', help='Config file', default=pathlib.Path.home()/'imagetrove/imagetrove.ini')
+    parser.add_argument('--repeat', help='number of timed passes', type=int, default=3)
+    args = parser.parse_args()
+
+    cfg = configparser.ConfigParser()
+    cfg.read(args.config)
+    tags = scan_tags(cfg)
+    routing = Routing(cfg)
+    infiles = [x for x in pathlib.Path(args.indir).rglob('*') if x.is_file()]
+
+    # Sanity check that both parsers agree on the routing tags
+    for infile in infiles:
+        try:
+            full, fast = full_header(infile), read_header(infile, tags)
+        except pydicom.errors.InvalidDicomError:
+            continue
+        for tag in tags:
+            if str(getattr(full, tag, '')) != str(getattr(fast, tag, '')):
+                raise ValueError(f'{tag} differs in {infile}')
+
+    results = {'files': len(infiles), 'tags': tags}
+    for name, func in (
+            ('full_header', full_header),
+            ('read_header', lambda x: read_header(x, tags)),
+            ('scanner', lambda x: scanner(x, routing))):
+        seconds = min(timed(func, infiles)[0] for _ in range(args.repeat))
+        results[name] = {'seconds': seconds, 'files_per_second': len(infiles) / seconds if seconds else None}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
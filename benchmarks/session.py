@@ -0,0 +1,219 @@
+"""End-to-end benchmark of a session against a local fake MyTardis and staging host
+
+python -m benchmarks.session --series 8 --instances 100 --staging --output results.json
+python -m benchmarks.session --indir {input-directory} --compare baseline.json
+
+Times the scan, zip, checksum and push stages separately and prints the
+results as JSON, with the commit they were measured at.
+"""
+from benchmarks.fakes import FakeStaging
+from benchmarks.fakes import FakeTardis
+from benchmarks.generate import add_arguments
+from benchmarks.generate import generate
+from benchmarks.generate import write_config
+from imgtr.dicom import dir_scan
+from imgtr.dicom import make_pool
+from imgtr.dicom import push_series
+from imgtr.dicom import zip_series
+from imgtr.job import Job
+from imgtr.utils import checksums
+import imgtr.utils
+import argparse
+import configparser
+import contextlib
+import json
+import logging
+import os
+import paramiko
+import pathlib
+import platform
+import subprocess
+import tempfile
+import time
+
+
+def commit():
+    """Current git commit of the repository, None outside a git checkout"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=pathlib.Path(__file__).parent, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def tree_size(indir):
+    """(number of files, bytes) under indir"""
+    nfiles = 0
+    nbytes = 0
+    for root, _, files in os.walk(indir):
+        for name in files:
+            nfiles += 1
+            nbytes += os.path.getsize(os.path.join(root, name))
+    return nfiles, nbytes
+
+
+class Stages:
+    """Wall time, throughput and request counts of each timed stage"""
+    def __init__(self, tardis, staging=None):
+        self.tardis = tardis
+        self.staging = staging
+        self.results = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, files, nbytes):
+        requests = dict(self.tardis.requests)
+        sftp_bytes = self.staging.stats['bytes'] if self.staging else 0
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        self.results[name] = {
+            'seconds': seconds,
+            'files': files,
+            'bytes': nbytes,
+            'files_per_second': files / seconds if seconds else None,
+            'mb_per_second': nbytes / seconds / 1e6 if seconds else None,
+            'requests': {x: self.tardis.requests[x] - requests[x] for x in requests}
+        }
+        if self.staging:
+            self.results[name]['sftp_bytes'] = self.staging.stats['bytes'] - sftp_bytes
+        logging.info(f'{name} took {seconds:.2f}s')
+
+
+def run_session(indir, config, tmproot, cores, uploads, tardis, staging=None):
+    """Runs every stage of a job over indir
+    :return: dict of results per stage
+    """
+    job = Job(indir, config)
+    job.config_optionals()
+    job.tmproot = pathlib.Path(tmproot)
+    job.cores = cores
+    job.uploads = uploads
+    job.server_from_cfg()
+    job.staging_from_cfg()
+    job.make_tmpdir()
+    stages = Stages(tardis, staging)
+    with job.tmphandle:
+        pools = make_pool(job)
+        nfiles, nbytes = tree_size(indir)
+        with stages.stage('scan', nfiles, nbytes):
+            job.manifest.add_scan(dir_scan(indir=job.indir, cores=job.cores, pools=pools))
+        series = job.manifest.series()
+        infiles = {x: job.manifest.files(x) for x in series}
+        ndicoms = sum(len(x) for x in infiles.values())
+        nbytes = sum(os.path.getsize(y) for x in infiles.values() for y in x)
+        with stages.stage('zip', ndicoms, nbytes):
+            zips = [zip_series(infiles[x], x, job.tmpdir, pools if job.cores > 1 else None) for x in series]
+        nbytes = sum(os.path.getsize(x) for x in zips)
+        # zip_series hashes while writing, forget it to time a cold checksum
+        imgtr.utils._checksum_cache.clear()
+        with stages.stage('checksum', len(zips), nbytes):
+            for serieszip in zips:
+                checksums(serieszip)
+        with stages.stage('push', len(zips), nbytes):
+            job.open_staging()
+            results = push_series([(str(x), y) for x, y in zip(zips, series)], job.server, job.cfg, job.staging,
+                                  job.uploads)
+            job.staging.close()
+        pools.close()
+        pools.join()
+        job.manifest.close()
+        job.server.close()
+    stages.results['push']['failed'] = len([x for x in results if x[1]])
+    return stages.results
+
+
+def compare(baseline, results):
+    """Speedup of every stage against baseline results"""
+    comparison = {}
+    for name, stage in results['stages'].items():
+        before = baseline.get('stages', {}).get(name)
+        if before:
+            comparison[name] = {
+                'baseline': before['seconds'],
+                'seconds': stage['seconds'],
+                'speedup': before['seconds'] / stage['seconds'] if stage['seconds'] else None
+            }
+    return {'baseline_commit': baseline.get('commit'), 'commit': results['commit'], 'stages': comparison}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--indir', help='Existing input directory, a synthetic session is generated if missing')
+    parser.add_argument('--config', help='Config routing indir, a generated one routes the synthetic session')
+    add_arguments(parser)
+    parser.add_argument('--cores', type=int, default=os.cpu_count(), help='number of cpu cores')
+    parser.add_argument('--uploads', type=int, default=1, help='number of series uploaded concurrently')
+    parser.add_argument('--staging', action='store_true', help='upload through the fake SFTP staging host')
+    parser.add_argument('--tunnel', action='store_true', help='send API calls through an SSH tunnel')
+    parser.add_argument('--streams', type=int, help='SFTP streams per file')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='seconds added to every API request')
+    parser.add_argument('--sftp-latency', type=float, default=0.0, help='seconds added to every SFTP request')
+    parser.add_argument('--bandwidth', type=float, help='staging bandwidth limit in MB/s')
+    parser.add_argument('--output', help='JSON results file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory(prefix='imgtr-bench-') as workdir:
+        workdir = pathlib.Path(workdir)
+        store = workdir/'store'
+        store.mkdir()
+        tardis = FakeTardis(latency=args.api_latency, storagebox=store).start()
+        fake_staging = None
+        staging = None
+        if args.staging:
+            bandwidth = args.bandwidth * 1e6 if args.bandwidth else None
+            fake_staging = FakeStaging(latency=args.sftp_latency, bandwidth=bandwidth).start()
+            key = workdir/'key'
+            paramiko.RSAKey.generate(2048).write_private_key_file(str(key))
+            staging = {'user': 'bench', 'host': '127.0.0.1', 'port': str(fake_staging.port), 'key': str(key),
+                       'tunnel': str(args.tunnel)}
+            if args.streams:
+                staging['streams'] = str(args.streams)
+
+        if args.indir:
+            indir = pathlib.Path(args.indir)
+            session = {'indir': str(indir)}
+            instruments = args.instruments
+        else:
+            indir = workdir/'session'
+            session = generate(indir, args.instruments, args.studies, args.series, args.instances, args.size,
+                               args.invalid, args.seed)
+            instruments = session['instruments']
+        config = write_config(workdir/'imagetrove.ini', instruments, tardis.url, staging)
+        if args.config:
+            # Routing from the given config, server and staging from the fakes
+            cfg = configparser.ConfigParser()
+            cfg.optionxform = str
+            cfg.read([args.config, config])
+            with open(config, 'w') as merged:
+                cfg.write(merged)
+        tmproot = workdir/'tmp'
+        tmproot.mkdir()
+
+        stages = run_session(indir, config, tmproot, args.cores, args.uploads, tardis, fake_staging)
+        tardis.stop()
+        if fake_staging:
+            fake_staging.stop()
+
+    results = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'session': session,
+        'settings': {x: getattr(args, x) for x in (
+            'cores', 'uploads', 'staging', 'tunnel', 'streams', 'api_latency', 'sftp_latency', 'bandwidth')},
+        'stages': stages,
+        'seconds': sum(x['seconds'] for x in stages.values())
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    print(json.dumps(results, indent=2))
+    if args.compare:
+        with open(args.compare) as baseline:
+            print(json.dumps(compare(json.load(baseline), results), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import json
+import logging
+import pathlib
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ObjectCache:
+    """Persistent sqlite cache of MyTardis objects keyed by server URL, model and query
+    Also records the series zips this client uploaded, so series already in
+    MyTardis are recognised before they are zipped again.
+    """
+    # Default time to live of cached objects in seconds
+    DEFAULT_TTL = 86400
+
+    def __init__(self, path, ttl=DEFAULT_TTL):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS objects ('
+                'url TEXT, model TEXT, query TEXT, result TEXT, created REAL, '
+                'PRIMARY KEY (url, model, query))'
+            )
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS uploads ('
+                'url TEXT, series TEXT, fingerprint TEXT, filename TEXT, size INTEGER, studytime TEXT, created REAL, '
+                'PRIMARY KEY (url, series, fingerprint))'
+            )
+
+    def get(self, url, model, query):
+        """Cached result of query, None on a miss or if expired"""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT result, created FROM objects WHERE url=? AND model=? AND query=?',
+                (url, model, query)
+            ).fetchone()
+        if row is None:
+            return None
+        result, created = row
+        if time.time() - created > self.ttl:
+            self.invalidate(url, model, query)
+            return None
+        logging.debug(f'Cache hit {model} {query}')
+        return json.loads(result)
+
+    def set(self, url, model, query, result):
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)',
+                (url, model, query, json.dumps(result), time.time())
+            )
+
+    def upload(self, url, series, fingerprint):
+        """Datafile filename, size and studytime of the series zip uploaded from these files, None if unknown"""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT filename, size, studytime FROM uploads WHERE url=? AND series=? AND fingerprint=?',
+                (url, series, fingerprint)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('filename', 'size', 'studytime'), row))
+
+    def set_upload(self, url, series, fingerprint, filename, size, studytime):
+        """Records the verified upload of a series zip"""
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (url, series, fingerprint, filename, size, studytime, time.time())
+            )
+
+    def invalidate(self, url, model=None, query=None):
+        """Removes cached results of a query, a model or a whole server"""
+        sql = 'DELETE FROM objects WHERE url=?'
+        params = [url]
+        if model is not None:
+            sql += ' AND model=?'
+            params.append(model)
+        if query is not None:
+            sql += ' AND query=?'
+            params.append(query)
+        with self.lock, self.db:
+            self.db.execute(sql, params)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -9,84 +9,382 @@ from imgtr.tardis import Group
 from imgtr.tardis import StorageBox
 from imgtr.staging import upload_file
 from imgtr.utils import safe_name
+from imgtr.utils import HashingWriter
+from imgtr.utils import checksums
+from imgtr.utils import file_identity
+from imgtr.utils import remember_checksums
+from concurrent.futures import ThreadPoolExecutor
+import imgtr.profiling
 import multiprocessing as mp
 from functools import partial
+import threading
 import pathlib
 import logging
 import pydicom
-from imgtr.utils import zipdir
+from pydicom.datadict import tag_for_keyword
+from pydicom.filereader import read_partial
 import datetime
 import json
+import io
+import zipfile
+import itertools
+import collections
+import zlib
+import hashlib
 import os
+import shutil
+import time
 
 logger = logging.getLogger(__name__)
 
 
 def run(job):
-    # Scanning all dicoms for all series
-    logging.info('Scanning all dicoms for all series')
-    pools = mp.Pool(processes=job.cores)
-    # Compiling list of dicoms and json metadata
-    dicom_json_tuples = dir_scan(indir=job.indir, cfg=job.cfg, experiment=job.experiment, dataset=job.dataset, instrument=job.instrument, cores=job.cores)
-
-    # Making series output dir
-    logging.info('Making series output directories')
-    series_json_tuples = make_series_dirs(dicom_json_tuples, outdir=job.tmpdir)
-
-
-    # Sorting dicom
-    logging.info('Sorting dicoms into series dirs ...')
-    if job.cores > 1:
-        pools.starmap(partial(sorter, outdir=job.tmpdir), dicom_json_tuples)
-    else:
-        # for dicom_json_tuple in dicom_json_tuples:
-        #     sorter(*dicom_json_tuple, job.tmpdir)
-        [sorter(*x, job.tmpdir) for x in dicom_json_tuples]
-
-    logging.info('Zipping dicoms into series zips ...')
-    if job.cores > 1:
-        pools.map(zipdir, [x[0] for x in series_json_tuples])
+    pools = make_pool(job)
+    job.open_staging()
+    try:
+        session(job, pools)
+    finally:
+        job.staging.close()
+        pools.close()
+        pools.join()
+
+
+def batch(job, indirs):
+    """Runs a session per input dir, sharing pools, HTTP session, SSH connections and hierarchies
+    Each session has its own tmpdir and manifest, so it can be resumed on its
+    own. A failed session is logged and the batch goes on with the next one.
+    :param job: job of the first input dir, later sessions share its resources
+    """
+    pools = make_pool(job)
+    job.open_staging()
+    hierarchies = Hierarchies(job.server, job.cfg)
+    failed = []
+    try:
+        for index, indir in enumerate(indirs, 1):
+            logging.info(f'Session {index}/{len(indirs)} {indir}')
+            start = time.perf_counter()
+            try:
+                session_job = job.for_indir(indir)
+                session_job.make_tmpdir()
+                with session_job.tmphandle:
+                    try:
+                        session(session_job, pools, hierarchies)
+                    finally:
+                        session_job.manifest.close()
+            except Exception as e:
+                failed.append(str(indir))
+                job.metrics.count('sessions_failed')
+                logging.error(f'Session {index}/{len(indirs)} {indir} failed after {time.perf_counter() - start:.1f}s: {e!r}')
+            else:
+                job.metrics.count('sessions_uploaded')
+                logging.info(f'Session {index}/{len(indirs)} {indir} done in {time.perf_counter() - start:.1f}s')
+            job.write_metrics()
+    finally:
+        job.staging.close()
+        pools.close()
+        pools.join()
+    if failed:
+        logging.error('{} of {} sessions failed ...\n{}'.format(len(failed), len(indirs), '\n'.join(failed)))
+        raise RuntimeError(f'{len(failed)} of {len(indirs)} sessions failed')
+
+
+def session(job, pools, hierarchies=None):
+    """Scans, zips and uploads all series of the job indir through open pools and staging
+    :param hierarchies: Hierarchies shared with other sessions, optional
+    """
+    manifest = job.manifest
+    if manifest.scanned:
+        logging.info('Series already scanned, reading them from manifest')
     else:
-        [zipdir(x) for x in [x[0] for x in series_json_tuples]]
-
-    job.staging.open()
-    push_series(
-        series_json_tuples=series_json_tuples,
-        server=job.server,
-        cfg=job.cfg,
-        ssh=job.staging.ssh
-    )
-    job.staging.close()
-
-
-def dir_scan(indir, cfg, experiment, dataset, instrument, cores):
-        pools = mp.Pool(processes=cores)
-        infiles = indir.glob('**/*')
-
-        scan_generator = ((x, cfg, experiment, dataset, instrument) for x in infiles)
-        if cores > 1:
-            scan_results = pools.starmap(scanner, scan_generator)
+        # Scanning all dicoms for all series
+        logging.info('Scanning all dicoms for all series')
+        # Streaming dicoms and json metadata into series in the manifest
+        dicom_json_tuples = dir_scan(indir=job.indir, cores=job.cores, pools=pools)
+        start = time.perf_counter()
+        with imgtr.profiling.stage('scan'):
+            nfiles = manifest.add_scan(dicom_json_tuples)
+        job.metrics.add_stage('scan', time.perf_counter() - start, nfiles)
+        duplicates, duplicate_bytes = manifest.duplicates()
+        job.metrics.count('duplicate_files', duplicates)
+        job.metrics.count('duplicate_bytes', duplicate_bytes)
+    logger.info("Series ...\n{}".format('\n'.join(manifest.series())))
+    series_files = ((x, manifest.files(x)) for x in manifest.series())
+
+    results = process_series(job, series_files, pools, manifest, hierarchies)
+    failures = [x for x in results if x[1]]
+    if failures:
+        logging.error(f'{len(failures)} of {len(results)} series failed to upload')
+        raise failures[0][1]
+
+
+# Zipped series waiting per upload thread, bounds how far zipping runs ahead of uploads
+UPLOAD_QUEUE = 2
+
+
+def process_series(job, series_files, pools, manifest=None, hierarchies=None):
+    """De-identifies and zips series, uploading each through the open staging as soon as it is zipped
+    Zipping in this thread and its pool workers overlaps uploads on
+    job.uploads threads. Zipping blocks while UPLOAD_QUEUE series per upload
+    thread wait, so zips never pile up in tmpdir ahead of slow uploads.
+    :param series_files: iterable of (series_json_string, list of infiles)
+    :param manifest: Manifest to resume from and record progress in, optional
+    :param hierarchies: Hierarchies shared with other calls, optional
+    :return: list of (serieszip, exception or None) per series, in series_files order,
+        serieszip is None for series already in MyTardis
+    """
+    hierarchies = hierarchies if hierarchies else Hierarchies(job.server, job.cfg)
+    slots = threading.Semaphore(job.uploads * (UPLOAD_QUEUE + 1))
+    futures = []
+    fingerprints = {}
+    series_files = plan_series(job, series_files, hierarchies, fingerprints, manifest)
+    logging.info(f'De-identifying and zipping dicoms into series zips, uploading {job.uploads} at a time ...')
+    with ThreadPoolExecutor(max_workers=job.uploads) as executor:
+        for series_json_string, serieszip in zip_all(job, series_files, pools, manifest):
+            if serieszip is None:
+                futures.append((None, None))
+                continue
+            slots.acquire()
+            future = executor.submit(push_one, serieszip, series_json_string, hierarchies, job.server, job.staging, manifest,
+                                     fingerprints.get(series_json_string))
+            future.add_done_callback(lambda x: slots.release())
+            futures.append((serieszip, future))
+    return upload_results(futures, job.server)
+
+
+def series_fingerprint(infiles):
+    """Digest of the paths, sizes and mtimes of the input files of a series"""
+    digest = hashlib.sha1()
+    for infile in sorted(str(x) for x in infiles):
+        stat = os.stat(infile)
+        digest.update(f'{infile}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()
+
+
+def plan_series(job, series_files, hierarchies, fingerprints, manifest=None):
+    """Drops series an earlier run uploaded that MyTardis still holds verified
+    Input files are matched on their fingerprint against the uploads recorded
+    in the object cache, then the recorded datafile is looked up in the
+    listing of its dataset, fetched once per dataset. Nothing is skipped
+    without the object cache.
+    :param fingerprints: dict filled with the fingerprint of every series
+    :return: generator of (series_json_string, infiles), infiles is None if the series is already uploaded
+    """
+    server = job.server
+    for series_json_string, infiles in series_files:
+        if not server.cache:
+            yield series_json_string, infiles
+            continue
+        with job.metrics.stage('plan', 1):
+            fingerprint = series_fingerprint(infiles)
+            fingerprints[series_json_string] = fingerprint
+            record = server.cache.upload(server.url, series_json_string, fingerprint)
+            uploaded = record is not None and remote_verified(job, series_json_string, record, hierarchies)
+        if uploaded:
+            logging.info(f'{record["filename"]} already uploaded and verified. Skipping ...')
+            job.metrics.count('series_skipped')
+            if manifest:
+                manifest.update(series_json_string, 'verified')
+            yield series_json_string, None
         else:
-            scan_results = [scanner(*x) for x in scan_generator]
-        return scan_results
-
-
-def make_series_dirs(scan_results, outdir):
-    series_json_strings = sorted(set((x[1] for x in scan_results)))
-    logger.info("Series ...\n{}".format('\n'.join(series_json_strings)))
-    series_json_tuples = []
-    for series_json_string in series_json_strings:
-        series_json = json.loads(series_json_string)
-        seriesdir = outdir/series_json['facility']/series_json['experiment']/series_json['dataset']/series_json['study']/series_json['series']
-        seriesdir.mkdir(parents=True, exist_ok=True)
-        series_json_tuples.append((str(seriesdir), series_json_string))
-    return series_json_tuples
-
-
-def scanner(infile, cfg, experiment, dataset, instrument):
+            yield series_json_string, infiles
+
+
+def remote_verified(job, series_json_string, record, hierarchies):
+    """True if the dataset of series holds the recorded datafile, verified and of the recorded size"""
+    with job.staging.connection() as ssh:
+        _, dataset = hierarchies.get(json.loads(series_json_string), record['studytime'], ssh)
+        result = dataset.datafiles(ssh).get(record['filename'])
+    if not result or not result['replicas'] or not result['replicas'][0]['verified']:
+        return False
+    return str(result['size']) == str(record['size'])
+
+
+def zip_all(job, series_files, pools, manifest=None):
+    """Streams series zips, reusing zips of an earlier run recorded in manifest
+    :param series_files: iterable of (series_json_string, infiles), infiles None to pass series through unzipped
+    :return: generator of (series_json_string, path of series zip or None)
+    """
+    for series_json_string, infiles in series_files:
+        if infiles is None:
+            yield series_json_string, None
+            continue
+        serieszip = resume_zip(series_json_string, manifest) if manifest else None
+        if serieszip is None:
+            # Dicoms are de-identified while they are zipped, sorting is timed as part of zip
+            start = time.perf_counter()
+            level = job.cfg.getint(json.loads(series_json_string)['instrument'], 'zip-level', fallback=None)
+            with imgtr.profiling.stage('zip'):
+                serieszip = zip_series(infiles, series_json_string, outdir=job.tmpdir, pools=pools if job.cores > 1 else None,
+                                      level=level)
+            job.metrics.add_stage('zip', time.perf_counter() - start, len(infiles), serieszip.stat().st_size)
+            if manifest:
+                with job.metrics.stage('hash', 1, serieszip.stat().st_size), imgtr.profiling.stage('hash'):
+                    record_zip(series_json_string, serieszip, manifest)
+        yield series_json_string, str(serieszip)
+
+
+def dir_scan(indir, cores, pools=None):
+    """Streams scanner results of all files under indir, skipping invalid files"""
+    return scan_files(iter_files(indir), cores, pools if cores > 1 else None)
+
+
+def iter_files(indir):
+    """Streams paths of files under indir, directories are never sent to the scanner"""
+    stack = [str(indir)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry.path
+
+
+# Upper bound of files sent to a scan worker at a time
+SCAN_MAX_CHUNKSIZE = 256
+
+
+def scan_chunksize(nfiles, cores):
+    """Chunksize giving each worker about four chunks, within 1 and SCAN_MAX_CHUNKSIZE"""
+    return max(1, min(SCAN_MAX_CHUNKSIZE, nfiles // (cores * 4)))
+
+
+# Files taken from the input stream at a time, bounds memory of the scan
+SCAN_BATCH = 8192
+
+
+def scan_files(infiles, cores, pools=None):
+    """Scans dicoms in pool workers, or in this process if pools is None
+    Workers use the routing installed by make_pool, only paths are sent to them.
+    Input is consumed in batches of SCAN_BATCH so any number of files can be streamed.
+    :param infiles: iterable of input files
+    :return: generator of (infile, series_json_string, SOPInstanceUID, size), in completion order, without invalid files
+    """
+    infiles = iter(infiles)
+    batch = list(itertools.islice(infiles, SCAN_BATCH))
+    while batch:
+        if pools:
+            scan_results = pools.imap_unordered(scanner, batch, scan_chunksize(len(batch), cores))
+        else:
+            scan_results = (scanner(x) for x in batch)
+        for scan_result in scan_results:
+            if scan_result is not None:
+                yield scan_result
+        batch = list(itertools.islice(infiles, SCAN_BATCH))
+
+
+def series_path(outdir, series_json):
+    """Path of series within the facility/experiment/dataset/study tree"""
+    return outdir/series_json['facility']/series_json['experiment']/series_json['dataset']/series_json['study']/series_json['series']
+
+
+# Tags every scan reads, on top of the configured experiment-tag and dataset-tag
+SCAN_TAGS = [
+    'SpecificCharacterSet',
+    'Manufacturer',
+    'StationName',
+    'StudyDate',
+    'StudyTime',
+    'StudyDescription',
+    'SeriesNumber',
+    'SeriesDescription',
+    'SOPInstanceUID'
+]
+# Values larger than this are not read by the scanner
+SCAN_DEFER_SIZE = 1024
+
+
+def scan_tags(cfg):
+    """Keywords of the tags routing needs for any instrument in config"""
+    tags = set(SCAN_TAGS)
+    for section in cfg.sections():
+        for option in ('experiment-tag', 'dataset-tag'):
+            if cfg.has_option(section, option):
+                tags.add(cfg.get(section, option))
+    return sorted(tags)
+
+
+def read_header(infile, tags):
+    """Reads only the requested tags from a dicom header
+    Non dicom files are rejected on the 128 byte preamble and DICM magic
+    before any parsing, the header is only parsed up to the last requested
+    tag and values larger than SCAN_DEFER_SIZE are deferred.
+    :param infile: input dicom
+    :param tags: keywords of tags to read
+    :return: pydicom dataset
+    :raises pydicom.errors.InvalidDicomError: if infile is not a dicom file
+    """
+    tags = [x for x in (tag_for_keyword(x) for x in tags) if x is not None]
+    last_tag = max(tags)
+    with open(str(infile), 'rb') as fp:
+        preamble = fp.read(132)
+        if len(preamble) < 132 or preamble[128:] != b'DICM':
+            raise pydicom.errors.InvalidDicomError(f'No DICM magic in {infile}')
+        fp.seek(0)
+        return read_partial(
+            fp,
+            stop_when=lambda tag, VR, length: tag > last_tag,
+            defer_size=SCAN_DEFER_SIZE,
+            specific_tags=tags
+        )
+
+
+class Routing:
+    """Instrument, facility and tag routing resolved once from config
+    Small enough to be installed once in every pool worker by init_worker
+    instead of pickling the whole ConfigParser for every file.
+    """
+    def __init__(self, cfg, experiment=None, dataset=None, instrument=None):
+        # Manual overrides
+        self.experiment = experiment
+        self.dataset = dataset
+        self.instrument = instrument
+        # ConfigParser option names are lower case
+        self.stations = {}
+        if cfg.has_section('Instrument Mapping'):
+            self.stations = {x: safe_name(y) for x, y in cfg.items('Instrument Mapping')}
+        self.facilities = {}
+        self.experiment_tags = {}
+        self.dataset_tags = {}
+        for section in cfg.sections():
+            if cfg.has_option(section, 'facility-name'):
+                self.facilities[section] = safe_name(cfg.get(section, 'facility-name'))
+            if cfg.has_option(section, 'experiment-tag'):
+                self.experiment_tags[section] = cfg.get(section, 'experiment-tag')
+            if cfg.has_option(section, 'dataset-tag'):
+                self.dataset_tags[section] = cfg.get(section, 'dataset-tag')
+        self.tags = scan_tags(cfg)
+
+
+# Routing of this process, installed by init_worker
+_routing = None
+
+
+def init_worker(routing, profile_dir=None):
+    """Pool initializer installing the routing table used by scanner
+    :param profile_dir: profiles the worker into this dir if set
+    """
+    global _routing
+    _routing = routing
+    imgtr.profiling.start(profile_dir, worker=True)
+
+
+def make_pool(job):
+    """Worker pool with the job routing installed in every worker and in this process"""
+    routing = Routing(job.cfg, job.experiment, job.dataset, job.instrument)
+    init_worker(routing)
+    return mp.Pool(processes=job.cores, initializer=init_worker, initargs=(routing, job.profile_dir))
+
+
+@imgtr.profiling.profiled('scan')
+def scanner(infile, routing=None):
+    routing = routing if routing else _routing
+    experiment = routing.experiment
+    dataset = routing.dataset
+    instrument = routing.instrument
     infile = str(infile)
     try:
-        with pydicom.dcmread(infile, stop_before_pixels=True) as dcm:
+        with read_header(infile, routing.tags) as dcm:
             if not instrument:
                 try:
                     station = safe_name('-'.join([dcm.Manufacturer, dcm.StationName]))
@@ -100,7 +398,7 @@ def scanner(infile, cfg, experiment, dataset, instrument):
                     # raise ValueError
 
                 try:
-                    instrument = safe_name(cfg['Instrument Mapping'][station])
+                    instrument = routing.stations[station.lower()]
                 except KeyError:
                     logging.error(f'{station} not found in config [Instrument Mapping]')
                     raise
@@ -108,8 +406,8 @@ def scanner(infile, cfg, experiment, dataset, instrument):
                     logging.error(f'Instrument name not found in config [Instrument Mapping]')
                     raise ValueError
 
-            if cfg.has_option(instrument, 'facility-name'):
-                facility = safe_name(cfg[instrument]['facility-name'])
+            if instrument in routing.facilities:
+                facility = routing.facilities[instrument]
                 if not facility:
                     logging.error(f'Facility name not found in config [{instrument}]')
                     raise ValueError
@@ -118,12 +416,12 @@ def scanner(infile, cfg, experiment, dataset, instrument):
 
             if not experiment:
                 try:
-                    experiment = safe_name(getattr(dcm, cfg[instrument]['experiment-tag']))
+                    experiment = safe_name(getattr(dcm, routing.experiment_tags[instrument]))
                 except KeyError:
                     logging.error('experiment-tag entry missing in config')
                     raise
                 except AttributeError:
-                    logging.error('{} not found in {}'.format(cfg[instrument]['experiment-tag'], infile))
+                    logging.error('{} not found in {}'.format(routing.experiment_tags[instrument], infile))
                     raise
                 if not experiment:
                     logging.error(f'Experiment value is blank in  {infile}')
@@ -132,13 +430,13 @@ def scanner(infile, cfg, experiment, dataset, instrument):
             if not dataset:
                 try:
                     studydatetime = datetime.datetime.strptime(f'{dcm.StudyDate}-{dcm.StudyTime}', "%Y%m%d-%H%M%S.%f").strftime("%Y%m%dT%H%M")
-                    dataset = safe_name(getattr(dcm, cfg[instrument]['dataset-tag']))
+                    dataset = safe_name(getattr(dcm, routing.dataset_tags[instrument]))
                     dataset = f'{dataset}-{studydatetime}'
                 except KeyError:
                     logging.error('dataset-tag entry missing in config')
                     raise
                 except AttributeError:
-                    logging.error('{} not found in {}'.format(cfg[instrument]['dataset-tag'], infile))
+                    logging.error('{} not found in {}'.format(routing.dataset_tags[instrument], infile))
                     raise
                 if not dataset:
                     logging.error(f'Dataset value is blank in {infile}')
@@ -175,14 +473,35 @@ def scanner(infile, cfg, experiment, dataset, instrument):
                 'study': study,
                 'series': series
             }
-            return infile, json.dumps(series_json)
+            # Identifies instances received more than once
+            sop_instance_uid = getattr(dcm, 'SOPInstanceUID', None)
+            return infile, json.dumps(series_json), str(sop_instance_uid) if sop_instance_uid else None, os.path.getsize(infile)
     except pydicom.errors.InvalidDicomError:
         logging.error(f'Invalid dicom file. Skipping ... {infile}')
 
 
-def sorter(infile, series_json_string, outdir):
+# Transfer syntaxes compressing the whole dataset, their pixel data cannot be copied as is
+DEFLATED_TRANSFER_SYNTAXES = ('1.2.840.10008.1.2.1.99',)
+# Standard transfer syntaxes of uncompressed pixel data, the other standard ones are compressed
+NATIVE_TRANSFER_SYNTAXES = ('1.2.840.10008.1.2', '1.2.840.10008.1.2.1', '1.2.840.10008.1.2.2', '1.2.840.10008.1.2.1.98')
+# Root of standard transfer syntax UIDs, private transfer syntaxes are deflated as their pixel data is unknown
+STANDARD_TRANSFER_SYNTAX = '1.2.840.10008.1.2.'
+# Block size when copying pixel data into the series zip
+COPY_BLOCKSIZE = 4 * 1024 * 1024
+# Members up to this size are compressed by pool workers, larger ones are streamed by the zip writer
+PACK_LIMIT = 64 * 1024 * 1024
+
+
+@imgtr.profiling.profiled('zip')
+def sorter(infile, series_json_string):
+    """De-identifies the header of a dicom in memory
+    Only the header is parsed and rewritten, the pixel data that follows it is
+    copied as is from infile by the zip writer.
+    :return: (zip member name, de-identified header bytes, infile, offset of
+        the pixel data in infile or None if the bytes hold the whole dicom,
+        TransferSyntaxUID)
+    """
     series_json = json.loads(series_json_string)
-    outdir = outdir/series_json['facility']/series_json['experiment']/series_json['dataset']/series_json['study']/series_json['series']
     ERASE_TAG_LIST = [
             0x00080050,
             0x00204000,
@@ -207,71 +526,306 @@ def sorter(infile, series_json_string, outdir):
             0x00100020
             # 0x00081030
         ]
-    with pydicom.dcmread(str(infile), stop_before_pixels=False) as dcm:
-        # ISO 9660 compliance dicom filename
-        outfilename = safe_name(f'{dcm.InstanceNumber:08}.dcm').lower()
-        outfile = (outdir/outfilename).resolve()
-        # De-identifying
-        for tag in ERASE_TAG_LIST:
-            if tag in dcm:
-                dcm[tag].value = ''
-        # Override StudyName with experiment
-        dcm[0x00080090].value = series_json['experiment']  # Referring Physician Name
-        # dcm[0x00200010].value = series_json['experiment']  # Study ID
-        # dcm[0x00081030].value = series_json['experiment']  # Study Description
-        # Override PatientName with dataset
-        dcm[0x00100010].value = series_json['dataset']  # Patient Name
-        dcm[0x00100020].value = series_json['dataset']  # Patient ID
-        # Saving output dicom file
-        dcm.save_as(str(outfile))
-
-
-def push_series(series_json_tuples, server, cfg, ssh):
-    for i in range(len(series_json_tuples)):
-        seriesdir = series_json_tuples[i][0]
-        series_json_string = series_json_tuples[i][1]
-
-        serieszip = pathlib.Path(os.path.join(os.path.dirname(seriesdir), '{}.zip'.format(os.path.basename(seriesdir)))).resolve(strict=True)
-        series_json = json.loads(series_json_string)
-        dicom = next((pathlib.Path(seriesdir)).glob('*.dcm'))
+    with open(str(infile), 'rb') as fp:
+        dcm = pydicom.dcmread(fp, stop_before_pixels=True)
+        # Reading stops right before the pixel data element
+        offset = fp.tell()
+        if getattr(dcm.file_meta, 'TransferSyntaxUID', None) in DEFLATED_TRANSFER_SYNTAXES:
+            fp.seek(0)
+            dcm = pydicom.dcmread(fp)
+            offset = None
+    # ISO 9660 compliance dicom filename
+    outfilename = safe_name(f'{dcm.InstanceNumber:08}.dcm').lower()
+    # De-identifying
+    for tag in ERASE_TAG_LIST:
+        if tag in dcm:
+            dcm[tag].value = ''
+    # Override StudyName with experiment
+    dcm[0x00080090].value = series_json['experiment']  # Referring Physician Name
+    # dcm[0x00200010].value = series_json['experiment']  # Study ID
+    # dcm[0x00081030].value = series_json['experiment']  # Study Description
+    # Override PatientName with dataset
+    dcm[0x00100010].value = series_json['dataset']  # Patient Name
+    dcm[0x00100020].value = series_json['dataset']  # Patient ID
+    # Saving output dicom to memory for the series zip writer
+    outbuffer = io.BytesIO()
+    dcm.save_as(outbuffer)
+    return outfilename, outbuffer.getvalue(), str(infile), offset, getattr(dcm.file_meta, 'TransferSyntaxUID', None)
+
+
+def zip_compression(transfer_syntax, level=None):
+    """Stores members whose pixel data is already compressed, deflates the others
+    :param level: deflate level 0 to 9, 0 stores every member
+    """
+    if level == 0 or transfer_syntax in DEFLATED_TRANSFER_SYNTAXES:
+        return zipfile.ZIP_STORED
+    if transfer_syntax and transfer_syntax not in NATIVE_TRANSFER_SYNTAXES \
+            and str(transfer_syntax).startswith(STANDARD_TRANSFER_SYNTAX):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+# Zip member of a de-identified dicom. Members packed by a worker hold their
+# compressed data with its crc and uncompressed size; otherwise crc is None,
+# data is the header and the zip writer streams the rest from infile at offset.
+Member = collections.namedtuple('Member', ['name', 'compress_type', 'data', 'crc', 'size', 'infile', 'offset'])
+
+
+@imgtr.profiling.profiled('zip')
+def pack(infile, series_json_string, level=None):
+    """De-identifies a dicom and compresses it into a zip member
+    Runs in pool workers, so members of a series compress in parallel and the
+    zip writer only appends them.
+    :param level: deflate level, zlib default if None
+    :return: Member
+    """
+    outfilename, header, infile, offset, transfer_syntax = sorter(infile, series_json_string)
+    compress_type = zip_compression(transfer_syntax, level)
+    size = len(header)
+    if offset is not None:
+        size += os.path.getsize(infile) - offset
+    if size > PACK_LIMIT:
+        return Member(outfilename, compress_type, header, None, size, infile, offset)
+    data = header
+    if offset is not None:
+        with open(infile, 'rb') as fp:
+            fp.seek(offset)
+            data += fp.read()
+    crc = zlib.crc32(data)
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(-1 if level is None else level, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    return Member(outfilename, compress_type, data, crc, size, None, None)
+
+
+def zip_series(infiles, series_json_string, outdir, pools=None, level=None):
+    """De-identifies and compresses dicoms of a series straight into the series zip
+    Workers de-identify and compress instances and send them to this single
+    writer so the uncompressed series directory never exists on disk.
+    :param infiles: dicoms of the series
+    :param series_json_string: series json from scanner
+    :param outdir: root dir of the facility/experiment/dataset/study tree
+    :param pools: multiprocessing pool, de-identifies in this process if None
+    :param level: deflate level 0 to 9, zlib default if None
+    :return: path of series zip
+    """
+    series_json = json.loads(series_json_string)
+    seriesdir = series_path(outdir, series_json)
+    seriesdir.parent.mkdir(parents=True, exist_ok=True)
+    serieszip = seriesdir.parent/f'{seriesdir.name}.zip'
+    logging.info(f'Zipping {serieszip.name}')
+    packer = partial(pack, series_json_string=series_json_string, level=level)
+    if pools:
+        members = pools.imap(packer, infiles)
+    else:
+        members = (packer(x) for x in infiles)
+    # Series zip is hashed while it is written
+    with HashingWriter(serieszip) as outfile, \
+            zipfile.ZipFile(outfile, 'w', zipfile.ZIP_DEFLATED, compresslevel=level) as zip_file:
+        for member in members:
+            if member.name in zip_file.NameToInfo:
+                logging.warning(f'{member.name} already in {serieszip.name}. Skipping ...')
+                continue
+            if member.crc is None:
+                write_member(zip_file, member)
+            else:
+                write_packed(zip_file, member)
+    return serieszip
+
+
+def member_info(zip_file, member):
+    """ZipInfo of member with the date, permissions and compression level ZipFile.writestr gives its members"""
+    zinfo = zipfile.ZipInfo(member.name, date_time=time.localtime()[:6])
+    zinfo.compress_type = member.compress_type
+    zinfo._compresslevel = zip_file.compresslevel
+    zinfo.external_attr = 0o600 << 16
+    return zinfo
+
+
+def write_member(zip_file, member):
+    """Writes a de-identified header followed by the pixel data copied from infile"""
+    zinfo = member_info(zip_file, member)
+    if member.offset is None:
+        zip_file.writestr(zinfo, member.data)
+        return
+    with zip_file.open(zinfo, 'w', force_zip64=member.size > zipfile.ZIP64_LIMIT) as dst, \
+            open(member.infile, 'rb') as src:
+        dst.write(member.data)
+        src.seek(member.offset)
+        shutil.copyfileobj(src, dst, COPY_BLOCKSIZE)
+
+
+def write_packed(zip_file, member):
+    """Appends a member compressed by pack, as ZipFile.writestr would have written it
+    Crc and sizes are known up front, so the local header needs no data descriptor.
+    """
+    zinfo = member_info(zip_file, member)
+    zinfo.file_size = member.size
+    zinfo.compress_size = len(member.data)
+    zinfo.CRC = member.crc
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    zinfo.header_offset = zip_file.fp.tell()
+    zip_file.fp.write(zinfo.FileHeader(zip64))
+    zip_file.fp.write(member.data)
+    zip_file.filelist.append(zinfo)
+    zip_file.NameToInfo[zinfo.filename] = zinfo
+    zip_file.start_dir = zip_file.fp.tell()
+
+
+class Hierarchies:
+    """MyTardis hierarchy of each dataset, each object fetched or created exactly once across upload threads"""
+    def __init__(self, server, cfg):
+        self.server = server
+        self.cfg = cfg
+        self.resolved = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, series_json, studytime, ssh=None):
+        """Resolves storagebox and dataset of series, the first series of a dataset creates them
+        :return: (storagebox, dataset)
+        """
+        key = tuple(series_json[x] for x in ('instrument', 'facility', 'experiment', 'dataset'))
+        return self.once(key, lambda: resolve_hierarchy(series_json, studytime, self.server, self.cfg, ssh, self.fetch))
+
+    def once(self, key, resolve):
+        """Result of resolve for key, threads asking for the same key wait for the first one"""
+        with self.lock:
+            lock = self.locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self.resolved:
+                self.resolved[key] = resolve()
+            return self.resolved[key]
+
+    def fetch(self, obj, create=True, ssh=None):
+        """Fetches or creates obj once per model and query, shared by all datasets above it
+        :return: the first object fetched for the model and query
+        """
+        def resolve():
+            obj.fetch(create=create, ssh=ssh)
+            return obj
+        return self.once((obj.model_name, obj.cache_key), resolve)
+
+
+def fetch_object(obj, create=True, ssh=None):
+    obj.fetch(create=create, ssh=ssh)
+    return obj
+
+
+def resolve_hierarchy(series_json, studytime, server, cfg, ssh, fetch=fetch_object):
+    """Fetches or creates MyTardis objects from storagebox down to dataset
+    :param fetch: fetches or creates an object and returns it, Hierarchies.fetch
+        shares objects above the dataset between concurrently resolved datasets
+    :return: (storagebox, dataset)
+    """
+    storagebox = fetch(StorageBox(server, cfg[series_json['instrument']]['storagebox']), False, ssh)
+    manager = fetch(Group(server, series_json['facility']), True, ssh)
+    facility = fetch(Facility(server, series_json['facility'], manager), True, ssh)
+    instrument = fetch(Instrument(server, series_json['instrument'], facility), True, ssh)
+    experiment = fetch(Experiment(server, series_json['experiment']), True, ssh)
+    group = fetch(Group(server, experiment), True, ssh)
+    dataset = fetch(Dataset(server, series_json['dataset'], experiment, instrument, series_json['study'], studytime),
+                    True, ssh)
+    fetch(ObjectACL(server, group, experiment), True, ssh)
+    fetch(ObjectACL(server, manager, experiment), True, ssh)
+    return storagebox, dataset
+
+
+def resume_zip(series_json_string, manifest):
+    """Series zip left by an earlier run of the job, seeding its checksums
+    :return: path of series zip, None if the series has to be zipped again
+    """
+    row = manifest.get(series_json_string)
+    if not manifest.reached(series_json_string, 'zipped') or not pathlib.Path(row['zip']).exists():
+        return None
+    serieszip = pathlib.Path(row['zip'])
+    if manifest.reached(series_json_string, 'hashed'):
+        identity = file_identity(serieszip)
+        if identity[1:] != (row['size'], row['mtime']):
+            logging.warning(f'{serieszip.name} changed since it was zipped')
+            return None
+        remember_checksums(identity, {'md5': row['md5'], 'sha512': row['sha512']})
+    logging.info(f'Reusing {serieszip.name}')
+    return serieszip
+
+
+def record_zip(series_json_string, serieszip, manifest):
+    """Records series zip and its checksums in the manifest"""
+    manifest.update(series_json_string, 'zipped', zip=str(serieszip))
+    identity = file_identity(serieszip)
+    digests = checksums(serieszip)
+    manifest.update(series_json_string, 'hashed', size=identity[1], mtime=identity[2], **digests)
+
+
+@imgtr.profiling.profiled('push')
+def push_one(serieszip, series_json_string, hierarchies, server, staging, manifest=None, fingerprint=None):
+    """Uploads a single series zip once its dataset hierarchy exists
+    Each series checks out its own staging SSH connection.
+    :param fingerprint: series_fingerprint of the input files, records the upload in the object cache
+    """
+    if manifest and manifest.reached(series_json_string, 'verified'):
+        logging.info(f'{pathlib.Path(serieszip).name} already uploaded')
+        return
+    progress = partial(manifest.update, series_json_string) if manifest else None
+    serieszip = pathlib.Path(serieszip).resolve(strict=True)
+    series_json = json.loads(series_json_string)
+    seriestime, studytime = series_times(serieszip)
+    with staging.connection() as ssh:
+        storagebox, dataset = hierarchies.get(series_json, studytime, ssh)
+        datafile = Datafile(server, serieszip, storagebox, dataset, series_json['study'], seriestime, studytime)
+        transferred = manifest is not None and manifest.reached(series_json_string, 'transferred')
+        upload_file(datafile, ssh, progress, transferred)
+    if fingerprint and server.cache:
+        server.cache.set_upload(server.url, series_json_string, fingerprint, datafile.name, serieszip.stat().st_size,
+                                studytime)
+
+
+def push_series(series_json_tuples, server, cfg, staging, uploads=1, manifest=None, hierarchies=None):
+    """Uploads series zips keeping up to `uploads` series in flight
+    :param staging: open Staging, its pool provides the SSH connections
+    :param hierarchies: Hierarchies resolved by earlier calls, a new one if None
+    :return: list of (serieszip, exception or None) per series
+    """
+    hierarchies = hierarchies if hierarchies else Hierarchies(server, cfg)
+    with ThreadPoolExecutor(max_workers=uploads) as executor:
+        futures = [(x[0], executor.submit(push_one, x[0], x[1], hierarchies, server, staging, manifest)) for x in series_json_tuples]
+    return upload_results(futures, server)
+
+
+def upload_results(futures, server):
+    """Waits for series uploads, logging and counting failures
+    :param futures: list of (serieszip, future of push_one), future is None for series not uploaded
+    :return: list of (serieszip, exception or None) per series
+    """
+    results = []
+    for serieszip, future in futures:
+        if future is None:
+            results.append((serieszip, None))
+            continue
+        error = future.exception()
+        if error:
+            logging.error(f'Upload of {serieszip} failed: {error!r}')
+            server.metrics.count('series_failed')
+        else:
+            server.metrics.count('series_uploaded')
+        results.append((serieszip, error))
+    return results
+
+
+def series_times(serieszip):
+    """Series and study times from the first dicom in the series zip
+    Falls back to the zip member timestamp if the dicom times are unusable
+    :return: (seriestime, studytime) as isoformat strings
+    """
+    with zipfile.ZipFile(str(serieszip)) as zip_file:
+        member = zip_file.infolist()[0]
         try:
-            with pydicom.dcmread(str(dicom), stop_before_pixels=True) as dcm:
+            with zip_file.open(member) as dicom, pydicom.dcmread(dicom, stop_before_pixels=True) as dcm:
                 timestring = f'{dcm.SeriesDate} {dcm.SeriesTime}'
                 seriestime = datetime.datetime.strptime(timestring, "%Y%m%d %H%M%S.%f").replace(microsecond=0).isoformat()
                 timestring = f'{dcm.StudyDate} {dcm.StudyTime}'
                 studytime = datetime.datetime.strptime(timestring, "%Y%m%d %H%M%S.%f").replace(microsecond=0).isoformat()
         except Exception:
-            seriestime = datetime.datetime.fromtimestamp(int(dicom.stat().st_ctime)).replace(microsecond=0).isoformat()
-            studytime = datetime.datetime.fromtimestamp(int(dicom.stat().st_ctime)).replace(microsecond=0).isoformat()
-
-        if i > 0 and old_series_json['instrument'] == series_json['instrument'] and \
-            old_series_json['facility'] == series_json['facility'] and \
-                old_series_json['experiment'] == series_json['experiment'] and \
-                old_series_json['dataset'] == series_json['dataset']:
-            ''' Current series shares dataset with previous series
-            Skipping MyTardis HTTP requests for dataset and above
-            '''
-            pass
-        else:
-            storagebox = StorageBox(server, cfg[series_json['instrument']]['storagebox'])
-            storagebox.fetch(ssh=ssh)
-            manager = Group(server, series_json['facility'])
-            manager.fetch(create=True, ssh=ssh)
-            facility = Facility(server, series_json['facility'], manager)
-            facility.fetch(create=True, ssh=ssh)
-            instrument = Instrument(server, series_json['instrument'], facility)
-            instrument.fetch(create=True, ssh=ssh)
-            experiment = Experiment(server, series_json['experiment'])
-            experiment.fetch(create=True, ssh=ssh)
-            group = Group(server, experiment)
-            group.fetch(create=True, ssh=ssh)
-            dataset = Dataset(server, series_json['dataset'], experiment, instrument, series_json['study'], studytime)
-            dataset.fetch(create=True, ssh=ssh)
-            groupacl = ObjectACL(server, group, experiment)
-            groupacl.fetch(create=True, ssh=ssh)
-            manageracl = ObjectACL(server, manager, experiment)
-            manageracl.fetch(create=True, ssh=ssh)
-
-        datafile = Datafile(server, serieszip, storagebox, dataset, series_json['study'], seriestime, studytime)
-        upload_file(datafile, ssh)
-        old_series_json = series_json
+            seriestime = datetime.datetime(*member.date_time).isoformat()
+            studytime = seriestime
+    return seriestime, studytime
@@ -0,0 +1,198 @@
+import datetime
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Blocking token bucket refilled at rate per second, unlimited if rate is None
+    Callers take tokens on credit, so an amount larger than the burst waits
+    for its share of the rate instead of failing.
+    """
+    def __init__(self, rate=None, burst=None):
+        self.lock = threading.Lock()
+        self.rate = None
+        self.burst = 0.0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.configure(rate, burst)
+
+    def configure(self, rate, burst=None):
+        """Changes the rate, burst defaults to one second of rate"""
+        with self.lock:
+            self.rate = rate if rate else None
+            self.burst = burst if burst else max(rate, 1) if rate else 0.0
+            self.tokens = min(self.tokens, self.burst)
+
+    def take(self, amount=1):
+        """Blocks until amount tokens were refilled
+        :return: seconds waited
+        """
+        with self.lock:
+            if self.rate is None:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class Concurrency:
+    """AIMD limit of concurrent requests, unlimited if maximum is None
+    The limit grows by one per limit requests answered within the latency
+    target and halves on a 429 or 5xx response, a failed request or a
+    latency above target, at most once per COOLDOWN.
+    """
+    # Seconds between two decreases, requests in flight during a decrease report the same overload
+    COOLDOWN = 1.0
+
+    def __init__(self, maximum=None, latency=None, minimum=1):
+        self.condition = threading.Condition()
+        self.minimum = minimum
+        self.maximum = None
+        self.latency = None
+        self.limit = None
+        self.active = 0
+        self.decreased = 0.0
+        self.configure(maximum, latency)
+
+    def configure(self, maximum, latency=None):
+        """Changes the maximum concurrency and latency target in seconds"""
+        with self.condition:
+            self.maximum = max(int(maximum), self.minimum) if maximum else None
+            self.latency = latency if latency else None
+            if self.maximum is None:
+                self.limit = None
+            else:
+                self.limit = min(self.limit, self.maximum) if self.limit else float(self.maximum)
+            self.condition.notify_all()
+
+    def acquire(self):
+        with self.condition:
+            while self.limit is not None and self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, seconds, status=None):
+        """Frees a slot and adapts the limit to the outcome of the request
+        :param seconds: latency of the request, None to ignore it
+        :param status: HTTP status of the response, None if the request failed
+        """
+        with self.condition:
+            self.active -= 1
+            if self.limit is not None:
+                overloaded = status is None or status == 429 or status >= 500
+                if self.latency and seconds is not None and seconds > self.latency:
+                    overloaded = True
+                if overloaded:
+                    now = time.monotonic()
+                    if now - self.decreased >= self.COOLDOWN:
+                        self.decreased = now
+                        self.limit = max(self.minimum, self.limit / 2)
+                        logging.debug(f'Request concurrency down to {int(self.limit)} after status {status} in {seconds}s')
+                else:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class Window:
+    """Limits applying daily from start to end local time, past midnight if end is before start
+    :param start: HH:MM
+    :param end: HH:MM
+    :param limits: dict of limits overriding the defaults of Governor
+    """
+    def __init__(self, start, end, limits):
+        self.start = datetime.datetime.strptime(start.strip(), '%H:%M').time()
+        self.end = datetime.datetime.strptime(end.strip(), '%H:%M').time()
+        self.limits = limits
+
+    def __str__(self):
+        return f'{self.start:%H:%M}-{self.end:%H:%M}'
+
+    def contains(self, now):
+        now = now.time()
+        if self.start <= self.end:
+            return self.start <= now < self.end
+        return now >= self.start or now < self.end
+
+
+class Governor:
+    """Byte rate, request rate and adaptive request concurrency shared by all transfers and API calls of a job
+    :param limits: dict of rate in bytes per second, requests per second,
+        concurrency and latency target in seconds, missing or 0 for no limit
+    :param windows: list of Window, the first containing the current time overrides limits
+    :param metrics: Metrics counting seconds spent throttled, optional
+    """
+    # Seconds between checks of the time windows
+    CHECK_INTERVAL = 60
+
+    def __init__(self, limits=None, windows=(), metrics=None):
+        self.defaults = dict(limits) if limits else {}
+        self.windows = list(windows)
+        self.metrics = metrics
+        self.bytes = TokenBucket()
+        self.requests = TokenBucket()
+        self.concurrency = Concurrency()
+        self.lock = threading.Lock()
+        self.window = None
+        self.checked = None
+        self.refresh()
+
+    @property
+    def active(self):
+        return bool(self.windows or any(self.defaults.values()))
+
+    def refresh(self):
+        """Applies the limits of the current time window, checked every CHECK_INTERVAL"""
+        now = time.monotonic()
+        with self.lock:
+            if self.checked is not None and now - self.checked < self.CHECK_INTERVAL:
+                return
+            first = self.checked is None
+            self.checked = now
+            current = datetime.datetime.now()
+            window = next((x for x in self.windows if x.contains(current)), None)
+            if not first and window is self.window:
+                return
+            self.window = window
+            limits = {**self.defaults, **(window.limits if window else {})}
+            self.bytes.configure(limits.get('rate'))
+            self.requests.configure(limits.get('requests'))
+            self.concurrency.configure(limits.get('concurrency'), limits.get('latency'))
+        if self.active:
+            logging.info(f'Governor limits {limits}' + (f' in window {window}' if window else ''))
+
+    def throttled(self, seconds):
+        if seconds and self.metrics:
+            self.metrics.count('throttled_seconds', seconds)
+
+    def consume(self, nbytes):
+        """Blocks until nbytes may be sent under the byte rate"""
+        if not self.active:
+            return
+        self.refresh()
+        self.throttled(self.bytes.take(nbytes))
+
+    def acquire(self):
+        """Blocks until an API request may start, pair with release"""
+        if not self.active:
+            return
+        self.refresh()
+        self.throttled(self.requests.take())
+        start = time.perf_counter()
+        self.concurrency.acquire()
+        self.throttled(time.perf_counter() - start)
+
+    def release(self, seconds, status=None):
+        """Ends an API request that took seconds, None to ignore its latency,
+        answered with HTTP status or None if it failed
+        """
+        if not self.active:
+            return
+        self.concurrency.release(seconds, status)
@@ -1,6 +1,8 @@
 
+import imgtr.profiling
 import imgtr.tardis
 import imgtr.dicom
+import imgtr.watch
 from imgtr.job import Job
 
 import argparse
@@ -15,24 +17,44 @@ def get_args(args=sys.argv[1:]):
     parser = argparse.ArgumentParser()
     # Required arguments
     parser.add_argument('datatype', help='input datatype: ')
-    parser.add_argument('indir', help='Input directory')
+    parser.add_argument('indir', nargs='*', help='Input directory, several are uploaded as a batch')
     # Optional arguments
     parser.add_argument('--config', help='Config file')
     parser.add_argument('--tmproot', help='Root dir to create tmpdir')
     parser.add_argument('--cores', help='number of cpu cores')
+    parser.add_argument('--uploads', help='number of series uploaded concurrently')
     parser.add_argument('--experiment', help='experiment name override')
     parser.add_argument('--dataset', help='dataset name override')
     parser.add_argument('--instrument', help='instrument name override')
-    args = parser.parse_args(args)
+    parser.add_argument('--resume', action='store_true', help='resume the last failed run of indir')
+    parser.add_argument('--watch', action='store_true', help='keep running and upload series as they arrive in indir')
+    parser.add_argument('--profile', nargs='?', const='', help='profile workers and parent per stage into this dir')
+    parser.add_argument('--batch', help='file listing input directories to upload as a batch, one per line')
+    # Options may sit between datatype and input dirs
+    args = parser.parse_intermixed_args(args)
+    args.indir = args.indir + (read_batch(args.batch) if args.batch else [])
+    if not args.indir:
+        parser.error('no input directory')
+    if args.watch and len(args.indir) > 1:
+        parser.error('--watch takes a single input directory')
     return args
 
 
+def read_batch(batchfile):
+    """Input directories listed in batchfile, skipping blank lines and # comments"""
+    with open(batchfile) as batch:
+        lines = [x.strip() for x in batch]
+    return [x for x in lines if x and not x.startswith('#')]
+
+
 def main(args=sys.argv[1:]):
     # Datatypes
     runner = {'dicom': imgtr.dicom.run}
+    watcher = {'dicom': imgtr.watch.watch}
+    batcher = {'dicom': imgtr.dicom.batch}
 
     args = get_args(args)
-    job = Job(args.indir, args.config)
+    job = Job(args.indir[0], args.config)
     # job = UPLOAD_JOB[args.datatype](args.indir, args.config)
     logging.info('Datatype %s' % args.datatype)
     logging.info('Job %s' % job)
@@ -45,18 +67,37 @@ def main(args=sys.argv[1:]):
     logging.info('Input data dir at %s' % job.indir)
     logging.info('Config file at %s' % job.config)
     logging.info('%s cores for multiprocessing' % job.cores)
+    logging.info('%s concurrent series uploads' % job.uploads)
 
     job.server_from_cfg()
     job.staging_from_cfg()
 
-    job.make_tmpdir()
-
-    with job.tmphandle:
-        logging.info('Created tmpdir at %s' % job.tmpdir)
-        runner[args.datatype](job)
-
-        # Zipping source files for archiving
-        # job.archive_indir()
+    imgtr.profiling.start(job.profile_dir)
+    try:
+        if len(args.indir) > 1:
+            logging.info('Batch of %s input dirs' % len(args.indir))
+            batcher[args.datatype](job, args.indir)
+        else:
+            job.make_tmpdir()
+            with job.tmphandle:
+                logging.info('Created tmpdir at %s' % job.tmpdir)
+                try:
+                    if args.watch:
+                        watcher[args.datatype](job)
+                    else:
+                        runner[args.datatype](job)
+                finally:
+                    job.manifest.close()
+    finally:
+        job.metrics.report()
+        job.write_metrics()
+        if job.profile_dir:
+            imgtr.profiling.dump()
+            imgtr.profiling.report(job.profile_dir)
+        job.server.close()
+
+    # Zipping source files for archiving
+    # job.archive_indir()
 
 
 if __name__ == '__main__':
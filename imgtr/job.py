@@ -1,11 +1,18 @@
 
+from imgtr.cache import ObjectCache
+from imgtr.governor import Governor
+from imgtr.governor import Window
+from imgtr.manifest import Manifest
+from imgtr.metrics import Metrics
 from imgtr.staging import Staging
 from imgtr.tardis import TardisServer
 from imgtr.utils import safe_name
-from imgtr.utils import create_tmpdir
+from imgtr.utils import create_workdir
 import tempfile
+import urllib.parse
 import pathlib
 import configparser
+import copy
 import multiprocessing
 import logging
 
@@ -19,6 +26,8 @@ class Job:
     DEFAULT_TMPROOT = pathlib.Path(tempfile.gettempdir())
     # Default number of cores
     DEFAULT_CORES = 1
+    # Default number of series uploaded concurrently
+    DEFAULT_UPLOADS = 1
 
     def __init__(self, indir, config=None):
         # Essential parameters
@@ -31,11 +40,20 @@ class Job:
 
         self.tmproot = self.DEFAULT_TMPROOT
         self.cores = self.DEFAULT_CORES
+        self.uploads = self.DEFAULT_UPLOADS
         self.cfg = self.parse_config()
         self.tmpdir = None
         self.tmphandle = None
+        self.resume = False
+        self.manifest = None
         self.server = None
         self.staging = None
+        self.metrics = Metrics(self.name)
+        self.governor = self.governor_from_cfg()
+        # Directory of the JSON and Prometheus metrics written at job end
+        self.metrics_dir = self.config.parent
+        # Directory of per stage profiles, profiling is off if None
+        self.profile_dir = None
 
         # Tardis objects
         self.instrument = None
@@ -61,6 +79,14 @@ class Job:
             cores = 1
         self._cores = cores
 
+    @property
+    def uploads(self):
+        return self._uploads
+
+    @uploads.setter
+    def uploads(self, uploads):
+        self._uploads = max(int(uploads), 1)
+
     def server_from_cfg(self):
         url = self.cfg.get('Server', 'Url')
         user = self.cfg.get('Server', 'User')
@@ -71,7 +97,21 @@ class Job:
             if self.cfg.has_option('Staging', 'curl'):
                 curl = eval(self.cfg.get('Staging', 'curl'))
                 pass
-        self.server = TardisServer(url=url, user=user, apikey=apikey, institution=institution, curl=curl)
+        pool_size = self.cfg.getint('Server', 'pool-size', fallback=TardisServer.DEFAULT_POOL_SIZE)
+        retries = self.cfg.getint('Server', 'retries', fallback=TardisServer.DEFAULT_RETRIES)
+        backoff = self.cfg.getfloat('Server', 'backoff', fallback=TardisServer.DEFAULT_BACKOFF)
+        timeout = self.cfg.getfloat('Server', 'timeout', fallback=TardisServer.DEFAULT_TIMEOUT)
+        keep_alive = self.cfg.getboolean('Server', 'keep-alive', fallback=True)
+        page_size = self.cfg.getint('Server', 'page-size', fallback=TardisServer.DEFAULT_PAGE_SIZE)
+        cache = None
+        if self.cfg.getboolean('Client', 'cache', fallback=True):
+            ttl = self.cfg.getfloat('Client', 'cache-ttl', fallback=ObjectCache.DEFAULT_TTL)
+            cache = ObjectCache(self.config.parent/'cache.sqlite', ttl=ttl)
+            logging.info('Object cache at %s' % cache.path)
+        self.server = TardisServer(url=url, user=user, apikey=apikey, institution=institution, curl=curl,
+                                   pool_size=pool_size, retries=retries, backoff=backoff, timeout=timeout,
+                                   keep_alive=keep_alive, cache=cache, page_size=page_size,
+                                   metrics=self.metrics, governor=self.governor)
         logging.info('Tardis server at %s' % self.server.url)
 
     def staging_from_cfg(self):
@@ -80,13 +120,65 @@ class Job:
             host = self.cfg.get('Staging', 'host')
             port = self.cfg.get('Staging', 'port')
             key = self.cfg.get('Staging', 'key')
-            self.staging = Staging(user=user, host=host, port=port, key=key)
+            streams = self.cfg.getint('Staging', 'streams', fallback=None)
+            split_size = self.cfg.getint('Staging', 'split-size', fallback=None)
+            if split_size is not None:
+                split_size = split_size * 1024 * 1024
+            connections = self.cfg.getint('Staging', 'connections', fallback=self.uploads)
+            tunnel = self.cfg.getboolean('Staging', 'tunnel', fallback=False)
+            self.staging = Staging(user=user, host=host, port=port, key=key, streams=streams, split_size=split_size,
+                                   connections=connections, tunnel=tunnel, metrics=self.metrics,
+                                   governor=self.governor)
             logging.info('Staging at %s' % self.staging.host)
         else:
-            self.staging = Staging()
+            self.staging = Staging(metrics=self.metrics, governor=self.governor)
+
+    def governor_from_cfg(self):
+        """Governor from [Governor] and the time windows of [Governor HH:MM-HH:MM] sections"""
+        def limits(section):
+            values = {}
+            if self.cfg.has_option(section, 'rate'):
+                values['rate'] = self.cfg.getfloat(section, 'rate') * 1e6
+            if self.cfg.has_option(section, 'requests'):
+                values['requests'] = self.cfg.getfloat(section, 'requests')
+            if self.cfg.has_option(section, 'concurrency'):
+                values['concurrency'] = self.cfg.getint(section, 'concurrency')
+            if self.cfg.has_option(section, 'latency'):
+                values['latency'] = self.cfg.getfloat(section, 'latency')
+            return values
+
+        defaults = limits('Governor') if self.cfg.has_section('Governor') else {}
+        windows = []
+        for section in self.cfg.sections():
+            if section.startswith('Governor '):
+                start, end = section[len('Governor '):].split('-')
+                windows.append(Window(start, end, limits(section)))
+        return Governor(defaults, windows, self.metrics)
+
+    def open_staging(self):
+        """Opens staging connections, tunnelling the server API through them if configured"""
+        self.staging.open()
+        if self.staging.active and self.staging.tunnel:
+            url = urllib.parse.urlsplit(self.server.url)
+            port = url.port if url.port else {'http': 80, 'https': 443}[url.scheme]
+            self.server.tunnel(self.staging.forward(url.hostname, port).address)
+
+    def for_indir(self, indir):
+        """Job of another indir sharing config, server, staging and metrics with this job"""
+        job = copy.copy(self)
+        job.indir = pathlib.Path(indir).resolve(strict=True)
+        job.name = safe_name(job.indir.name)
+        job.tmpdir = None
+        job.tmphandle = None
+        job.manifest = None
+        return job
+
+    def write_metrics(self):
+        self.metrics.write(self.metrics_dir)
 
     def make_tmpdir(self):
-        self.tmpdir, self.tmphandle = create_tmpdir(self.tmproot)
+        self.tmpdir, self.tmphandle = create_workdir(self.tmproot, self.name, self.indir, self.resume)
+        self.manifest = Manifest(self.tmpdir/'manifest.sqlite')
 
     def config_optionals(self):
         if self.cfg.has_option('Client', 'tmproot'):
@@ -94,18 +186,28 @@ class Job:
             self.tmproot = pathlib.Path(self.tmproot).resolve(strict=True)
         if self.cfg.has_option('Client', 'cores'):
             self.cores = self.cfg.get('Client', 'cores')
+        if self.cfg.has_option('Client', 'uploads'):
+            self.uploads = self.cfg.get('Client', 'uploads')
+        if self.cfg.has_option('Client', 'metrics-dir'):
+            self.metrics_dir = pathlib.Path(self.cfg.get('Client', 'metrics-dir'))
 
     def args_optionals(self, args):
         if args.tmproot:
             self.tmproot = pathlib.Path(args.tmproot).resolve(strict=True)
         if args.cores:
             self.cores = args.cores
+        if args.uploads:
+            self.uploads = args.uploads
         if args.experiment:
             self.experiment = args.experiment
         if args.dataset:
             self.dataset = args.dataset
         if args.instrument:
             self.instrument = args.instrument
+        if args.resume:
+            self.resume = True
+        if args.profile is not None:
+            self.profile_dir = pathlib.Path(args.profile) if args.profile else self.metrics_dir/f'{self.name}-profile'
 
     def parse_config(self):
         """parse config file to dictionary using ConfigParser module"""
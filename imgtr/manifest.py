@@ -0,0 +1,132 @@
+import itertools
+import logging
+import pathlib
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Manifest:
+    """Crash-safe sqlite record of job progress at series granularity
+    Every update is its own transaction, so a job killed at any point can be
+    resumed from the last stage each series reached.
+    """
+    # Stages a series goes through, in order
+    STAGES = ('scanned', 'sorted', 'zipped', 'hashed', 'registered', 'transferred', 'verified')
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS job (key TEXT PRIMARY KEY, value TEXT)')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS series ('
+                'series TEXT PRIMARY KEY, stage TEXT, zip TEXT, '
+                'md5 TEXT, sha512 TEXT, size INTEGER, mtime INTEGER)'
+            )
+            self.db.execute('CREATE TABLE IF NOT EXISTS files (series TEXT, path TEXT, sop TEXT, size INTEGER)')
+            columns = [x[1] for x in self.db.execute('PRAGMA table_info(files)')]
+            # Manifests written before SOPInstanceUID deduplication
+            for column, kind in (('sop', 'TEXT'), ('size', 'INTEGER')):
+                if column not in columns:
+                    self.db.execute(f'ALTER TABLE files ADD COLUMN {column} {kind}')
+            self.db.execute('CREATE INDEX IF NOT EXISTS files_series ON files (series)')
+            self.db.execute('CREATE UNIQUE INDEX IF NOT EXISTS files_sop ON files (sop)')
+
+    @property
+    def scanned(self):
+        """True once the scan of all input files has been recorded"""
+        with self.lock:
+            row = self.db.execute("SELECT value FROM job WHERE key='scan'").fetchone()
+        return row is not None
+
+    def add_scan(self, scan_results, batch=10000):
+        """Streams scanned files into their series, dropping duplicate instances
+        Files are written in transactions of batch files, so memory stays
+        bounded by the batch and not by the number of files. The scan only
+        counts as done once all results are in, a partial scan is redone.
+        Of files sharing a SOPInstanceUID only the one with the lowest path
+        is kept, whatever order the scan returned them in.
+        :param scan_results: iterable of (infile, series_json_string, SOPInstanceUID, size)
+        :return: number of files scanned
+        """
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM files')
+            self.db.execute('DELETE FROM series')
+        nfiles = 0
+        nbytes = 0
+        scan_results = iter(scan_results)
+        rows = list(itertools.islice(scan_results, batch))
+        while rows:
+            with self.lock, self.db:
+                self.db.executemany(
+                    'INSERT INTO files VALUES (?, ?, ?, ?) ON CONFLICT (sop) DO UPDATE SET '
+                    'series=excluded.series, path=excluded.path, size=excluded.size WHERE excluded.path < path',
+                    ((x[1], str(x[0]), x[2], x[3]) for x in rows)
+                )
+            nfiles += len(rows)
+            nbytes += sum(x[3] for x in rows)
+            rows = list(itertools.islice(scan_results, batch))
+        with self.lock, self.db:
+            # Series whose files were all duplicates of another series are left out
+            self.db.execute("INSERT INTO series (series, stage) SELECT DISTINCT series, 'scanned' FROM files")
+            kept, kept_bytes = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files').fetchone()
+            self.db.executemany('INSERT OR REPLACE INTO job VALUES (?, ?)', (
+                ('duplicates', str(nfiles - kept)),
+                ('duplicate_bytes', str(nbytes - kept_bytes)),
+                ('scan', 'done')
+            ))
+        logging.info(f'Scanned {nfiles} dicoms')
+        if nfiles > kept:
+            logging.info(f'Dropped {nfiles - kept} duplicate dicoms, {(nbytes - kept_bytes) / 1e6:.1f} MB')
+        return nfiles
+
+    def duplicates(self):
+        """(files, bytes) of duplicate instances dropped by the scan"""
+        with self.lock:
+            rows = dict(self.db.execute("SELECT key, value FROM job WHERE key IN ('duplicates', 'duplicate_bytes')"))
+        return int(rows.get('duplicates', 0)), int(rows.get('duplicate_bytes', 0))
+
+    def series(self):
+        """Scanned series_json_strings, sorted"""
+        with self.lock:
+            rows = self.db.execute('SELECT series FROM series ORDER BY series').fetchall()
+        return [x[0] for x in rows]
+
+    def files(self, series):
+        """Scanned files of series, sorted so series zips are reproducible"""
+        with self.lock:
+            rows = self.db.execute('SELECT path FROM files WHERE series=? ORDER BY path', (series,)).fetchall()
+        return [x[0] for x in rows]
+
+    def get(self, series):
+        """Manifest row of series as dict, None if not recorded"""
+        with self.lock:
+            cursor = self.db.execute('SELECT * FROM series WHERE series=?', (series,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip((x[0] for x in cursor.description), row))
+
+    def reached(self, series, stage):
+        """True if series has reached stage"""
+        row = self.get(series)
+        if row is None:
+            return False
+        return self.STAGES.index(row['stage']) >= self.STAGES.index(stage)
+
+    def update(self, series, stage, **values):
+        """Records that series reached stage, with optional zip, md5, sha512, size and mtime"""
+        columns = ''.join(f', {x}=?' for x in values)
+        with self.lock, self.db:
+            self.db.execute(
+                f'UPDATE series SET stage=?{columns} WHERE series=?',
+                (stage, *values.values(), series)
+            )
+        logging.debug(f'{series} {stage}')
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,170 @@
+import contextlib
+import json
+import logging
+import os
+import pathlib
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics:
+    """Thread-safe stage timers, counters, HTTP latency histograms and SFTP throughput of a job
+    Stages timed concurrently by several threads add up their seconds, so
+    a stage may report more seconds than the job took.
+    """
+    # Upper bounds in seconds of the HTTP latency histogram buckets
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name=''):
+        self.name = name
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.latency = {}
+        self.sftp = {'files': 0, 'bytes': 0, 'seconds': 0.0}
+
+    @contextlib.contextmanager
+    def stage(self, name, files=0, nbytes=0):
+        """Times the enclosed block as stage name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start, files, nbytes)
+
+    def add_stage(self, name, seconds, files=0, nbytes=0):
+        with self.lock:
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'count': 0, 'files': 0, 'bytes': 0})
+            stage['seconds'] += seconds
+            stage['count'] += 1
+            stage['files'] += files
+            stage['bytes'] += nbytes
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, method, path, seconds):
+        """Records the latency of an HTTP request, object ids in path are grouped as {id}"""
+        endpoint = re.sub(r'/\d+/', '/{id}/', path)
+        with self.lock:
+            histogram = self.latency.setdefault(
+                (method, endpoint),
+                {'buckets': [0] * len(self.BUCKETS), 'count': 0, 'sum': 0.0, 'max': 0.0}
+            )
+            for index, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+                    break
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['max'] = max(histogram['max'], seconds)
+
+    def transfer(self, nbytes, seconds):
+        """Records an SFTP upload of nbytes"""
+        with self.lock:
+            self.sftp['files'] += 1
+            self.sftp['bytes'] += nbytes
+            self.sftp['seconds'] += seconds
+
+    def summary(self):
+        """All metrics as a JSON serializable dict"""
+        with self.lock:
+            stages = {x: dict(y) for x, y in self.stages.items()}
+            for stage in stages.values():
+                stage['mb_per_second'] = stage['bytes'] / stage['seconds'] / 1e6 if stage['seconds'] and stage['bytes'] else None
+            latency = [
+                {
+                    'method': method,
+                    'endpoint': endpoint,
+                    'count': x['count'],
+                    'mean': x['sum'] / x['count'],
+                    'max': x['max'],
+                    'buckets': dict(zip((str(y) for y in self.BUCKETS), x['buckets']))
+                }
+                for (method, endpoint), x in sorted(self.latency.items())
+            ]
+            sftp = dict(self.sftp)
+            sftp['mb_per_second'] = sftp['bytes'] / sftp['seconds'] / 1e6 if sftp['seconds'] else None
+            return {
+                'job': self.name,
+                'started': self.started,
+                'seconds': time.time() - self.started,
+                'stages': stages,
+                'counters': dict(self.counters),
+                'http': latency,
+                'sftp': sftp
+            }
+
+    def prometheus(self):
+        """All metrics in the Prometheus text exposition format"""
+        job = self.name.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        lines = []
+
+        def metric(name, kind, description, samples):
+            lines.append(f'# HELP imgtr_{name} {description}')
+            lines.append(f'# TYPE imgtr_{name} {kind}')
+            for suffix, labels, value in samples:
+                labels = ','.join([f'job="{job}"', *(f'{x}="{y}"' for x, y in labels)])
+                lines.append(f'imgtr_{name}{suffix}{{{labels}}} {value}')
+
+        summary = self.summary()
+        stages = sorted(summary['stages'].items())
+        metric('job_seconds', 'gauge', 'Seconds since the job started', [('', [], summary['seconds'])])
+        metric('stage_seconds_total', 'counter', 'Seconds spent in each pipeline stage',
+               [('', [('stage', x)], y['seconds']) for x, y in stages])
+        metric('stage_files_total', 'counter', 'Files through each pipeline stage',
+               [('', [('stage', x)], y['files']) for x, y in stages])
+        metric('stage_bytes_total', 'counter', 'Bytes through each pipeline stage',
+               [('', [('stage', x)], y['bytes']) for x, y in stages])
+        for name, value in sorted(summary['counters'].items()):
+            metric(f'{name}_total', 'counter', name.replace('_', ' ').capitalize(), [('', [], value)])
+        samples = []
+        with self.lock:
+            histograms = sorted((x, dict(y)) for x, y in self.latency.items())
+        for (method, endpoint), histogram in histograms:
+            labels = [('method', method), ('endpoint', endpoint)]
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, histogram['buckets']):
+                cumulative += count
+                samples.append(('_bucket', labels + [('le', str(bound))], cumulative))
+            samples.append(('_bucket', labels + [('le', '+Inf')], histogram['count']))
+            samples.append(('_sum', labels, histogram['sum']))
+            samples.append(('_count', labels, histogram['count']))
+        metric('http_request_duration_seconds', 'histogram', 'Latency of MyTardis API requests', samples)
+        metric('sftp_files_total', 'counter', 'Files uploaded to staging', [('', [], summary['sftp']['files'])])
+        metric('sftp_bytes_total', 'counter', 'Bytes uploaded to staging', [('', [], summary['sftp']['bytes'])])
+        metric('sftp_seconds_total', 'counter', 'Seconds spent uploading to staging',
+               [('', [], summary['sftp']['seconds'])])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, outdir):
+        """Writes imagetrove.json and imagetrove.prom into outdir
+        Files are replaced atomically, so a textfile collector never reads a partial file.
+        """
+        outdir = pathlib.Path(outdir)
+        outdir.mkdir(parents=True, exist_ok=True)
+        for name, content in (
+                ('imagetrove.json', json.dumps(self.summary(), indent=2)),
+                ('imagetrove.prom', self.prometheus())):
+            tmpfile = outdir/f'.{name}.tmp'
+            tmpfile.write_text(content)
+            os.replace(str(tmpfile), str(outdir/name))
+        logging.debug(f'Metrics written to {outdir}')
+
+    def report(self):
+        """Logs stage times, API latency per endpoint and SFTP throughput"""
+        summary = self.summary()
+        for name, stage in summary['stages'].items():
+            rate = f', {stage["mb_per_second"]:.2f} MB/s' if stage['mb_per_second'] else ''
+            logging.info(f'{name} {stage["seconds"]:.2f}s, {stage["files"]} files, {stage["bytes"]/1e6:.1f} MB{rate}')
+        for endpoint in summary['http']:
+            logging.info(f'{endpoint["method"]} {endpoint["endpoint"]} {endpoint["count"]} requests, '
+                         f'mean {endpoint["mean"]:.3f}s, max {endpoint["max"]:.3f}s')
+        if summary['sftp']['files']:
+            logging.info(f'SFTP {summary["sftp"]["files"]} files, {summary["sftp"]["bytes"]/1e6:.1f} MB, '
+                         f'{summary["sftp"]["mb_per_second"]:.2f} MB/s')
@@ -0,0 +1,126 @@
+import cProfile
+import contextlib
+import functools
+import io
+import logging
+import multiprocessing.util
+import os
+import pathlib
+import pstats
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Default number of functions in each stage report
+DEFAULT_TOP = 40
+
+# Directory of the profiles of this process, profiling is off if None
+_profile_dir = None
+# cProfile.Profile per (stage, thread) of this process
+_profiles = {}
+_lock = threading.Lock()
+# Stage profiled by the calling thread, nested stages are part of it
+_local = threading.local()
+# From Python 3.12 cProfile holds the single profiler slot of the interpreter
+# and sees every thread, so each process runs one profiler for all its stages
+PROCESS_PROFILE = sys.version_info >= (3, 12)
+# Stage name of the whole process profile
+PROCESS_STAGE = 'process'
+
+
+def start(profile_dir, worker=False):
+    """Turns profiling on in this process
+    Worker processes dump their profiles when the pool shuts them down
+    with close and join, a terminated pool loses them. With PROCESS_PROFILE
+    the whole process is profiled from here on instead of each stage.
+    :param worker: True in pool workers, drops profiles inherited from the parent
+    """
+    global _profile_dir, _profiles
+    if profile_dir is None:
+        return
+    _profile_dir = pathlib.Path(profile_dir)
+    _profile_dir.mkdir(parents=True, exist_ok=True)
+    if worker:
+        # A forked worker inherits the profilers of the parent, still enabled with PROCESS_PROFILE
+        for profiler in _profiles.values():
+            profiler.disable()
+        _profiles = {}
+        multiprocessing.util.Finalize(None, dump, exitpriority=10)
+    if PROCESS_PROFILE:
+        if not worker:
+            logging.info(f'Python {sys.version_info[0]}.{sys.version_info[1]} profiles whole processes, '
+                         f'stages are not profiled separately')
+        profiler = cProfile.Profile()
+        with _lock:
+            _profiles[(PROCESS_STAGE, 0)] = profiler
+        profiler.enable()
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Profiles the enclosed block of the calling thread as stage name"""
+    if _profile_dir is None or PROCESS_PROFILE or getattr(_local, 'stage', None) is not None:
+        yield
+        return
+    with _lock:
+        profiler = _profiles.setdefault((name, threading.get_ident()), cProfile.Profile())
+    _local.stage = name
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _local.stage = None
+
+
+def profiled(name):
+    """Decorator profiling every call of a function as stage name"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profile_dir is None:
+                return func(*args, **kwargs)
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def dump():
+    """Writes the profiles of this process as {stage}-{pid}-{n}.pstats"""
+    with _lock:
+        profiles = list(_profiles.items())
+        _profiles.clear()
+    for index, ((name, _), profiler) in enumerate(profiles):
+        profiler.disable()
+        profiler.dump_stats(str(_profile_dir/f'{name}-{os.getpid()}-{index}.pstats'))
+
+
+def report(profile_dir, top=DEFAULT_TOP):
+    """Merges the profiles of all processes and threads
+    Writes {stage}.prof and a top {stage}.txt report per stage, and all
+    stages merged into profile.prof.
+    """
+    profile_dir = pathlib.Path(profile_dir)
+    stages = {}
+    for path in sorted(profile_dir.glob('*.pstats')):
+        stages.setdefault(path.name.split('-')[0], []).append(path)
+    merged = None
+    for name, paths in sorted(stages.items()):
+        stats = pstats.Stats(*(str(x) for x in paths))
+        stats.dump_stats(str(profile_dir/f'{name}.prof'))
+        output = io.StringIO()
+        stats.stream = output
+        print(f'{name}: {len(paths)} profiles merged', file=output)
+        stats.sort_stats('cumulative').print_stats(top)
+        (profile_dir/f'{name}.txt').write_text(output.getvalue())
+        if merged is None:
+            merged = pstats.Stats(*(str(x) for x in paths))
+        else:
+            merged.add(*(str(x) for x in paths))
+        for path in paths:
+            path.unlink()
+    if merged is not None:
+        merged.dump_stats(str(profile_dir/'profile.prof'))
+    logging.info(f'Profiles of {", ".join(sorted(stages))} written to {profile_dir}')
@@ -1,16 +1,42 @@
 
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import imgtr.profiling
 import paramiko
+import pathlib
+import queue
+import requests
+import select
+import socket
+import threading
 import logging
+import time
+import weakref
 logger = logging.getLogger(__name__)
 
 
 class Staging:
-    def __init__(self, user=None, host=None, port=None, key=None):
+    # Default number of pooled SSH connections
+    DEFAULT_CONNECTIONS = 1
+
+    def __init__(self, user=None, host=None, port=None, key=None, streams=None, split_size=None, connections=None,
+                 tunnel=False, metrics=None, governor=None):
         self.user = user
         self.host = host
         self.port = port
         self.key = key
-        self.ssh = None
+        self.streams = streams if streams is not None else Transfer.DEFAULT_STREAMS
+        self.split_size = split_size if split_size is not None else Transfer.DEFAULT_SPLIT_SIZE
+        self.connections = max(connections if connections else self.DEFAULT_CONNECTIONS, 1)
+        # Idle pooled connections, None for a slot to reconnect
+        self.idle = None
+        # Forward MyTardis API calls through an SSH tunnel
+        self.tunnel = tunnel
+        self.tunnels = []
+        # Metrics recording SFTP throughput, optional
+        self.metrics = metrics
+        # Governor pacing SFTP bytes, optional
+        self.governor = governor
 
     @property
     def active(self):
@@ -20,31 +46,376 @@ class Staging:
 
     def open(self):
         if self.active:
-            self.ssh = paramiko.SSHClient()
-            self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.ssh.connect(
-                hostname=self.host,
-                port=self.port,
-                username=self.user,
-                key_filename=self.key
-            )
+            logging.info(f'Opening {self.connections} SSH connections to {self.host}')
+            self.idle = queue.LifoQueue()
+            for _ in range(self.connections):
+                self.idle.put(self.connect())
+
+    def connect(self):
+        """New SSH connection with its own transfer engine"""
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(
+            hostname=self.host,
+            port=self.port,
+            username=self.user,
+            key_filename=self.key
+        )
+        Transfer.register(ssh, Transfer(ssh, self.streams, self.split_size, self.metrics, self.governor))
+        return ssh
+
+    def disconnect(self, ssh):
+        try:
+            Transfer.get(ssh).close()
+            ssh.close()
+        except Exception as e:
+            logging.warning(f'Closing SSH connection failed: {e!r}')
+
+    @staticmethod
+    def healthy(ssh):
+        """True if the connection is open and its transport still answers"""
+        if ssh is None:
+            return False
+        transport = ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (paramiko.SSHException, EOFError, OSError):
+            return False
+        return True
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Checks out a healthy SSH connection for exclusive use
+        Dead connections are replaced on checkout and a connection that
+        fails while checked out is dropped, so one stalled transfer never
+        blocks the others. HTTP errors of MyTardis calls keep the connection.
+        Yields None without staging.
+        """
+        if not self.active:
+            yield None
+            return
+        ssh = self.idle.get()
+        try:
+            if not self.healthy(ssh):
+                if ssh is not None:
+                    logging.warning('SSH connection lost, reconnecting')
+                    self.disconnect(ssh)
+                ssh = None
+                ssh = self.connect()
+            yield ssh
+        except requests.RequestException:
+            # Subclasses OSError but says nothing about the SSH connection
+            raise
+        except (paramiko.SSHException, EOFError, OSError):
+            if ssh is not None:
+                self.disconnect(ssh)
+            ssh = None
+            raise
+        finally:
+            self.idle.put(ssh)
+
+    def forward(self, host, port):
+        """Opens a Tunnel to host:port as seen from the staging host
+        :return: Tunnel, its local address accepts connections
+        """
+        tunnel = Tunnel(self, host, port)
+        self.tunnels.append(tunnel)
+        return tunnel
 
     def close(self):
-        if self.active:
+        for tunnel in self.tunnels:
+            tunnel.close()
+        self.tunnels = []
+        if self.active and self.idle is not None:
             logging.info('Closing SSH session')
-            self.ssh.close()
+            while not self.idle.empty():
+                ssh = self.idle.get()
+                if ssh is not None:
+                    self.disconnect(ssh)
+            self.idle = None
+
+
+class Tunnel:
+    """Local port forwarded to host:port through a staging SSH connection
+    Every accepted local connection gets its own direct-tcpip channel on a
+    connection dedicated to the tunnel, which is reopened if it drops.
+    """
+    def __init__(self, staging, host, port):
+        self.staging = staging
+        self.host = host
+        self.port = port
+        self.ssh = staging.connect()
+        self.lock = threading.Lock()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.address = self.listener.getsockname()
+        self.closed = False
+        threading.Thread(target=self.accept, daemon=True).start()
+        logging.info(f'Tunnel from {self.address[0]}:{self.address[1]} to {host}:{port} through {staging.host}')
+
+    def channel(self, peer):
+        with self.lock:
+            if not Staging.healthy(self.ssh):
+                logging.warning('Tunnel SSH connection lost, reconnecting')
+                self.staging.disconnect(self.ssh)
+                self.ssh = self.staging.connect()
+            return self.ssh.get_transport().open_channel('direct-tcpip', (self.host, self.port), peer)
+
+    def accept(self):
+        while not self.closed:
+            try:
+                client, peer = self.listener.accept()
+            except OSError:
+                break
+            try:
+                channel = self.channel(peer)
+            except (paramiko.SSHException, EOFError, OSError) as e:
+                logging.error(f'Tunnel to {self.host}:{self.port} failed: {e!r}')
+                client.close()
+                continue
+            threading.Thread(target=self.pump, args=(client, channel), daemon=True).start()
+
+    @staticmethod
+    def pump(client, channel):
+        """Copies bytes both ways until either side closes"""
+        try:
+            while True:
+                readable, _, _ = select.select([client, channel], [], [])
+                if client in readable:
+                    data = client.recv(65536)
+                    if not data:
+                        break
+                    channel.sendall(data)
+                if channel in readable:
+                    data = channel.recv(65536)
+                    if not data:
+                        break
+                    client.sendall(data)
+        except (OSError, EOFError, paramiko.SSHException):
+            pass
+        finally:
+            channel.close()
+            client.close()
+
+    def close(self):
+        self.closed = True
+        self.listener.close()
+        with self.lock:
+            self.staging.disconnect(self.ssh)
+
+
+class Transfer:
+    """SFTP transfer engine on one staging SSH connection
+    Each of its writer threads keeps its own SFTP session, so a connection
+    holds at most streams sessions whatever threads call put. Remote dirs
+    already created are cached and files of split_size or more go as
+    concurrently written byte ranges. A range that fails resumes from its
+    last acknowledged offset.
+    """
+    # Default number of concurrent byte ranges of a large file
+    DEFAULT_STREAMS = 4
+    # Default size in bytes from which files are split into ranges
+    DEFAULT_SPLIT_SIZE = 64 * 1024 * 1024
+    # Bytes read from the local file per write
+    BLOCKSIZE = 1024 * 1024
+    # Bytes written between acknowledged checkpoints of a range
+    CHECKPOINT = 16 * 1024 * 1024
+    # Attempts of a range before the transfer fails
+    RETRIES = 3
 
+    # Transfer engine of each SSH connection
+    _registry = weakref.WeakKeyDictionary()
+    _registry_lock = threading.Lock()
 
-def upload_file(datafile, ssh):
-    """Static upload sequence for map/multiprocessing"""
+    def __init__(self, ssh, streams=DEFAULT_STREAMS, split_size=DEFAULT_SPLIT_SIZE, metrics=None, governor=None):
+        self.ssh = ssh
+        self.streams = streams
+        self.split_size = split_size
+        self.metrics = metrics
+        self.governor = governor
+        self.local = threading.local()
+        self.sessions = []
+        self.dirs = set()
+        self.lock = threading.Lock()
+        # Range writers outlive single transfers so their SFTP sessions are reused
+        self.executor = ThreadPoolExecutor(max_workers=streams)
+
+    @classmethod
+    def register(cls, ssh, transfer):
+        with cls._registry_lock:
+            cls._registry[ssh] = transfer
+
+    @classmethod
+    def get(cls, ssh):
+        """Transfer engine of SSH connection, created with defaults if none was registered"""
+        with cls._registry_lock:
+            if ssh not in cls._registry:
+                cls._registry[ssh] = cls(ssh)
+            return cls._registry[ssh]
+
+    @property
+    def sftp(self):
+        """SFTP session of the calling writer thread"""
+        sftp = getattr(self.local, 'sftp', None)
+        if sftp is None:
+            sftp = self.ssh.open_sftp()
+            self.local.sftp = sftp
+            with self.lock:
+                self.sessions.append(sftp)
+        return sftp
+
+    def reset(self):
+        """Drops the SFTP session of the calling thread after an error"""
+        sftp = getattr(self.local, 'sftp', None)
+        self.local.sftp = None
+        if sftp is not None:
+            with self.lock:
+                self.sessions.remove(sftp)
+            try:
+                sftp.close()
+            except Exception:
+                pass
+
+    def makedirs(self, remotedir):
+        """Creates remotedir and its parents, probing each only once per connection"""
+        remotedir = pathlib.PurePosixPath(remotedir)
+        for path in reversed([remotedir, *remotedir.parents]):
+            path = str(path)
+            if path in self.dirs:
+                continue
+            try:
+                self.sftp.stat(path)
+            except IOError:
+                try:
+                    self.sftp.mkdir(path)
+                except IOError:
+                    # Created by another thread in the meantime
+                    self.sftp.stat(path)
+            with self.lock:
+                self.dirs.add(path)
+
+    def put(self, localfile, remotefile):
+        """Uploads localfile to remotefile
+        :return: bytes per second
+        """
+        localfile = pathlib.Path(localfile)
+        size = localfile.stat().st_size
+        start = time.perf_counter()
+        # SFTP requests run on the writer threads, callers open no sessions of their own
+        self.run(self.create, remotefile)
+        if size >= self.split_size and self.streams > 1:
+            step = -(-size // self.streams)
+            ranges = [(x, min(x + step, size)) for x in range(0, size, step)]
+        else:
+            ranges = [(0, size)]
+        futures = [self.executor.submit(self.put_range, localfile, remotefile, *x) for x in ranges]
+        for future in futures:
+            future.result()
+        remote_size = self.run(lambda: self.sftp.stat(str(remotefile)).st_size)
+        if remote_size != size:
+            raise IOError(f'{remotefile} holds {remote_size} bytes after transfer, expected {size}')
+        elapsed = time.perf_counter() - start
+        rate = size / elapsed if elapsed else 0
+        if self.metrics:
+            self.metrics.transfer(size, elapsed)
+        logging.info(f'Transferred {localfile.name} {size/1e6:.1f} MB in {elapsed:.1f}s, {rate/1e6:.2f} MB/s over {len(ranges)} streams')
+        return rate
+
+    def run(self, method, *args):
+        """Result of method on a writer thread, dropping its SFTP session if it fails"""
+        def call():
+            try:
+                return method(*args)
+            except (IOError, EOFError, paramiko.SSHException):
+                self.reset()
+                raise
+        return self.executor.submit(call).result()
+
+    def create(self, remotefile):
+        """Creates or truncates remotefile and its dirs before ranges are written into it"""
+        self.makedirs(pathlib.PurePosixPath(remotefile).parent)
+        with self.sftp.open(str(remotefile), 'w'):
+            pass
+
+    @imgtr.profiling.profiled('push')
+    def put_range(self, localfile, remotefile, start, end):
+        """Writes bytes start to end of localfile into remotefile, pipelined"""
+        acked = start
+        for attempt in range(self.RETRIES + 1):
+            offset = acked
+            try:
+                with open(str(localfile), 'rb') as src, self.sftp.open(str(remotefile), 'r+') as dst:
+                    dst.set_pipelined(True)
+                    src.seek(offset)
+                    dst.seek(offset)
+                    while offset < end:
+                        data = src.read(min(self.BLOCKSIZE, end - offset))
+                        if self.governor:
+                            self.governor.consume(len(data))
+                        dst.write(data)
+                        offset += len(data)
+                        if offset - acked >= self.CHECKPOINT:
+                            self.confirm(dst)
+                            acked = offset
+                    self.confirm(dst)
+                return
+            except (IOError, EOFError, paramiko.SSHException) as e:
+                if attempt == self.RETRIES:
+                    raise
+                logging.warning(f'Range {start}-{end} of {localfile.name} failed at {acked}: {e!r}. Resuming ...')
+                self.reset()
+
+    @staticmethod
+    def confirm(dst):
+        """Waits for the status of every pipelined write to dst, raising IOError on a failed one
+        Any other request on the SFTP session, stat or close included, would
+        read and silently drop these statuses, so they are drained first.
+        """
+        dst.flush()
+        while dst._reqs:
+            kind, _ = dst.sftp._read_response(dst._reqs.popleft())
+            if kind != paramiko.sftp.CMD_STATUS:
+                raise paramiko.SFTPError('Expected status')
+
+    def close(self):
+        self.executor.shutdown()
+        with self.lock:
+            sessions, self.sessions = self.sessions, []
+        for sftp in sessions:
+            sftp.close()
+
+
+def upload_file(datafile, ssh, progress=None, transferred=False):
+    """Static upload sequence for map/multiprocessing
+    :param progress: optional callable called with each stage reached,
+        'registered', 'transferred' and 'verified'
+    :param transferred: an earlier run transferred the file, only verified
+        if MyTardis holds a datafile of the same size and checksum
+    """
+    progress = progress if progress else lambda stage: None
+    metrics = datafile.server.metrics
     datafile.fetch(create=False, ssh=ssh)
     if not datafile.verified:
-        if ssh:
-            datafile.fetch(create=True, ssh=ssh)
-            datafile.scp(ssh=ssh)
+        size = datafile.file.stat().st_size
+        if transferred and datafile.matches():
+            logging.info(f'{datafile.name} already transferred, verifying')
+        elif ssh:
+            with metrics.stage('register', 1):
+                datafile.fetch(create=True, ssh=ssh)
+            progress('registered')
+            with metrics.stage('transfer', 1, size):
+                datafile.scp(ssh=ssh)
+            progress('transferred')
         else:
-            datafile.fetch(create=True, ssh=ssh, files=datafile.file)
-        datafile.verify(ssh=ssh)
+            with metrics.stage('transfer', 1, size):
+                datafile.fetch(create=True, ssh=ssh, files=datafile.file)
+            progress('transferred')
+        with metrics.stage('verify', 1):
+            datafile.verify(ssh=ssh)
+        progress('verified')
     else:
         size = str(datafile.file.stat().st_size)
         if size != str(datafile.size):
@@ -61,4 +432,6 @@ def upload_file(datafile, ssh):
                     datafile.name = newname
                 datafile.verified = False
                 datafile.count = datafile.count + 1
-                upload_file(datafile, ssh)
+                upload_file(datafile, ssh, progress)
+        else:
+            progress('verified')
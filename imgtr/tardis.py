@@ -1,26 +1,258 @@
 
-from imgtr.utils import checksum
+from imgtr.governor import Governor
+from imgtr.metrics import Metrics
+from imgtr.staging import Transfer
+from imgtr.utils import checksums
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import urllib3
+import urllib3.util.connection
 import mimetypes
 import pathlib
+import re
 import requests
+import threading
+import time
 import json
+import uuid
 import logging
 import urllib
 import urllib.parse
 from urllib.parse import urlencode
 logger = logging.getLogger(__name__)
 
+# Resource URI of an object, model and ID
+RESOURCE_URI = re.compile(r'/api/v1/(\w+)/(\d+)/')
+
+
+class TunnelAdapter(HTTPAdapter):
+    """HTTPAdapter opening its TCP connections to a local tunnel address
+    TLS, certificate checks and the Host header still use the server URL.
+    """
+    def __init__(self, address, **kwargs):
+        self.address = address
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        address = self.address
+
+        def new_conn(connection):
+            return urllib3.util.connection.create_connection(
+                address, connection.timeout, source_address=connection.source_address,
+                socket_options=connection.socket_options
+            )
+
+        http_connection = type('TunnelHTTPConnection', (urllib3.connection.HTTPConnection,), {'_new_conn': new_conn})
+        https_connection = type('TunnelHTTPSConnection', (urllib3.connection.HTTPSConnection,), {'_new_conn': new_conn})
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': type('TunnelHTTPConnectionPool', (urllib3.HTTPConnectionPool,), {'ConnectionCls': http_connection}),
+            'https': type('TunnelHTTPSConnectionPool', (urllib3.HTTPSConnectionPool,), {'ConnectionCls': https_connection})
+        }
+
+
+class GetRetry(Retry):
+    """Retry of GET requests only
+    urllib3 retries connection errors of any method, a POST fails on its
+    first error instead, so uploads are only retried by TardisServer.upload.
+    """
+    def increment(self, method=None, url=None, *args, **kwargs):
+        if method is not None and method.upper() not in self.allowed_methods:
+            return Retry.increment(self.new(total=0), method, url, *args, **kwargs)
+        return Retry.increment(self, method, url, *args, **kwargs)
+
+
+class MultipartBody:
+    """Streamed multipart/form-data body of text fields and one file, never held in memory
+    Requests sends it with a Content-Length and reads it in small blocks,
+    each paced by the governor. Progress is logged every PROGRESS_INTERVAL.
+    :param fields: dict of text fields sent before the file
+    :param name: field name of the file
+    :param path: file to send
+    """
+    # Bytes read from the file at a time
+    BLOCKSIZE = 1024 * 1024
+    # Seconds between progress messages
+    PROGRESS_INTERVAL = 10
+
+    def __init__(self, fields, name, path, governor=None):
+        self.path = pathlib.Path(path)
+        self.governor = governor
+        boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        head = b''.join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{x}"\r\n\r\n{y}\r\n'.encode()
+            for x, y in fields.items()
+        )
+        mimetype = mimetypes.guess_type(self.path.name)[0] or 'application/octet-stream'
+        head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{self.path.name}"\r\n'
+                 f'Content-Type: {mimetype}\r\n\r\n').encode()
+        self.head = head
+        self.tail = f'\r\n--{boundary}--\r\n'.encode()
+        self.size = self.path.stat().st_size
+        self.length = len(self.head) + self.size + len(self.tail)
+        self.file = None
+        self.position = 0
+        self.reported = None
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        data = self.read(self.BLOCKSIZE)
+        while data:
+            yield data
+            data = self.read(self.BLOCKSIZE)
+
+    def read(self, size=-1):
+        if self.file is None:
+            self.file = open(str(self.path), 'rb')
+            self.reported = time.monotonic()
+        size = self.length - self.position if size is None or size < 0 else size
+        data = b''
+        if self.position < len(self.head):
+            data = self.head[self.position:self.position + size]
+        offset = self.position + len(data) - len(self.head)
+        if len(data) < size and 0 <= offset < self.size:
+            data += self.file.read(min(size - len(data), self.size - offset))
+        offset = self.position + len(data) - len(self.head) - self.size
+        if len(data) < size and offset >= 0:
+            data += self.tail[offset:offset + size - len(data)]
+        self.position += len(data)
+        if self.governor:
+            self.governor.consume(len(data))
+        if time.monotonic() - self.reported >= self.PROGRESS_INTERVAL:
+            self.reported = time.monotonic()
+            sent = min(max(self.position - len(self.head), 0), self.size)
+            logging.info(f'Uploading {self.path.name} {sent/1e6:.1f} of {self.size/1e6:.1f} MB')
+        return data
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
 
 class TardisServer:
-    def __init__(self, url, user, apikey, institution, curl=False):
+    # Default size of the keep-alive connection pool
+    DEFAULT_POOL_SIZE = 10
+    # Default number of retries for idempotent GET requests
+    DEFAULT_RETRIES = 3
+    # Default backoff factor in seconds between retries
+    DEFAULT_BACKOFF = 0.5
+    # Default socket timeout in seconds
+    DEFAULT_TIMEOUT = 300
+    # Default number of objects per page of a listing
+    DEFAULT_PAGE_SIZE = 500
+
+    def __init__(self, url, user, apikey, institution, curl=False, pool_size=DEFAULT_POOL_SIZE,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, timeout=DEFAULT_TIMEOUT, keep_alive=True,
+                 cache=None, page_size=DEFAULT_PAGE_SIZE, metrics=None, governor=None):
         self.url = url
         self.user = user
         self.apikey = apikey
         self.institution = institution
         self.curl = curl
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.page_size = page_size
         self.headers = {"Authorization": f"ApiKey {user}:{apikey}"}
+        # Persistent ObjectCache of object IDs, disabled if None
+        self.cache = cache
+        # Cache key of objects loaded from the cache by (model, ID)
+        self.cached = {}
+        # Request latency per endpoint, shared with the rest of the job
+        self.metrics = metrics if metrics else Metrics()
+        # Rate and concurrency limits shared with staging transfers, unlimited by default
+        self.governor = governor if governor else Governor()
+
+        # Pooled keep-alive session, only GETs are retried, after Retry-After on 429
+        retry = GetRetry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False
+        )
+        self.adapter_kwargs = {'pool_connections': pool_size, 'pool_maxsize': pool_size, 'max_retries': retry}
+        adapter = HTTPAdapter(**self.adapter_kwargs)
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def tunnel(self, address):
+        """Sends all API calls through a local tunnel address instead of curl on the staging host"""
+        adapter = TunnelAdapter(address, **self.adapter_kwargs)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.curl = False
+
+    def request(self, method, url, **kwargs):
+        """HTTP request through the pooled session, paced by the governor, recording its latency"""
+        self.governor.acquire()
+        start = time.perf_counter()
+        status = None
+        try:
+            response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            status = response.status_code
+            if self.cache and response.status_code in (400, 404):
+                self.invalidate(method, url, kwargs.get('data'))
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            # Upload time depends on file size, not on how loaded the server is
+            self.governor.release(None if isinstance(kwargs.get('data'), MultipartBody) else elapsed, status)
+            self.metrics.observe(method, urllib.parse.urlparse(url).path, elapsed)
+            logging.debug(f'{method} {url} took {elapsed:.3f}s')
+
+    def from_cache(self, model, query):
+        """Cached result of query, remembered to invalidate it if a request referencing it fails"""
+        result = self.cache.get(self.url, model, query)
+        if result is not None:
+            self.cached[(model, str(result.get('id')))] = query
+        return result
+
+    def invalidate(self, method, url, data):
+        """Invalidates the cached objects whose resource URI a failed request referenced
+        A cached object referenced by the request may no longer exist.
+        """
+        text = url + (data.head.decode() if isinstance(data, MultipartBody) else str(data or ''))
+        for model, id_ in set(RESOURCE_URI.findall(text)):
+            query = self.cached.pop((model, id_), None)
+            if query is not None:
+                logging.warning(f'{method} {url} failed, invalidating cached {model} {id_}')
+                self.cache.invalidate(self.url, model, query)
+
+    def close(self):
+        self.session.close()
+        if self.cache:
+            self.cache.close()
 
     def get(self, apipath, ssh=None):
+        """Objects of the first page of a listing, None if there are none"""
+        results = self.get_json(apipath, ssh)
+        if results and 'objects' in results:
+            return results['objects']
+        else:
+            return None
+
+    def get_pages(self, apipath, ssh=None):
+        """Lazily yields all objects of a listing, following meta.next page by page"""
+        separator = '&' if '?' in apipath else '?'
+        apipath = f'{apipath}{separator}limit={self.page_size}'
+        while apipath:
+            results = self.get_json(apipath, ssh)
+            if not results or 'objects' not in results:
+                return
+            yield from results['objects']
+            apipath = results.get('meta', {}).get('next')
+
+    def get_json(self, apipath, ssh=None):
+        """Decoded JSON response of a GET, None if empty"""
         url = urllib.parse.urljoin(self.url, apipath)
         # logging.info(f'GET {url}')
         if ssh and self.curl is True:
@@ -30,36 +262,59 @@ class TardisServer:
             response = stdout.read()
         else:
             logging.info(f'GET {url}')
-            response = requests.get(headers=self.headers, url=url).text
+            response = self.request('GET', url).text
 
         if response:
-            results = json.loads(response)
-            if 'objects' in results:
-                return results['objects']
-            else:
-                return None
+            return json.loads(response)
         else:
             return None
 
-    def post(self, apipath, data, ssh=None, files=None):
+    def post(self, apipath, data, ssh=None, files=None, stored=None):
+        """POSTs JSON data, with the file at path files attached as multipart if given
+        :param stored: callable returning True if a failed multipart upload
+            was stored anyway, checked before the upload is retried
+        """
         url = urllib.parse.urljoin(self.url, apipath)
-        logging.info(f'POST {url} {data}')
+        logging.info(f'POST {url}')
+        logging.debug(data)
         if ssh and self.curl is True:
             cmd = f'curl --header \"Authorization: ApiKey {self.user}:{self.apikey}\" --header \"Content-Type: application/json\" --data \'{data}\' --request POST \"{url}\"'
             _, stdout, stderr = ssh.exec_command(cmd)
             response = stdout.read()
-            logging.info(response)
+            logging.debug(response)
         else:
             if files is not None:
-                file_obj = open(files, 'rb')
-                headers = {"Authorization": f"ApiKey {self.user}:{self.apikey}"}
-                response = requests.post(headers=headers, url=url, data={"json_data": data}, files={'attached_file': file_obj}).text
-                logging.info(response)
-                file_obj.close()
+                response = self.upload(url, data, files, stored)
+                logging.debug(response)
             else:
-                headers = {"Authorization": f"ApiKey {self.user}:{self.apikey}", "Content-Type": "application/json"}
-                response = requests.post(headers=headers, url=url, data=data).text
-                logging.info(response)
+                headers = {"Content-Type": "application/json"}
+                response = self.request('POST', url, headers=headers, data=data).text
+                logging.debug(response)
+
+    def upload(self, url, data, path, stored=None):
+        """Streams a multipart upload of path with data as json_data in constant memory
+        Uploads failing on the connection, a 429 or a 5xx response are
+        retried from the start up to retries times with backoff, unless
+        stored reports that the failed attempt was stored and verified anyway.
+        :return: response text
+        """
+        for attempt in range(self.retries + 1):
+            body = MultipartBody({'json_data': data}, 'attached_file', path, self.governor)
+            try:
+                response = self.request('POST', url, data=body, headers={'Content-Type': body.content_type})
+                if response.status_code == 429 or response.status_code >= 500:
+                    response.raise_for_status()
+                return response.text
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                if attempt == self.retries:
+                    raise
+                logging.warning(f'Upload of {pathlib.Path(path).name} failed: {e!r}. Retrying ...')
+                time.sleep(self.backoff * 2 ** attempt)
+                if stored and stored():
+                    logging.info(f'{pathlib.Path(path).name} was stored by the failed upload')
+                    return None
+            finally:
+                body.close()
 
 
 class TardisObject:
@@ -71,15 +326,41 @@ class TardisObject:
         self.new_json = {}
         self.query = {'name':self.name}
 
+    @property
+    def cache_key(self):
+        """Key of object in the persistent cache"""
+        return urlencode(self.query)
+
     def fetch(self, create=False, ssh=None):
+        if self.from_cache():
+            return
         query_string = urlencode(self.query)
         results = self.server.get(f'/api/v1/{self.model_name}/?format=json&{query_string}', ssh)
         if results:
-            self.id = results[-1]['id']
+            self.load(results[-1])
+            self.to_cache(results[-1])
         elif create:
             self.server.post(f'/api/v1/{self.model_name}/?format=json', json.dumps(self.new_json), ssh)
             self.fetch(False, ssh)
 
+    def load(self, result):
+        """Sets attributes from API result"""
+        self.id = result['id']
+
+    def from_cache(self):
+        """Loads object from the server's persistent cache, True on a hit"""
+        if not self.server.cache:
+            return False
+        result = self.server.from_cache(self.model_name, self.cache_key)
+        if result is None:
+            return False
+        self.load(result)
+        return True
+
+    def to_cache(self, result):
+        if self.server.cache:
+            self.server.cache.set(self.server.url, self.model_name, self.cache_key, result)
+
     def __str__(self):
         return self.name
 
@@ -128,16 +409,10 @@ class Experiment(TardisObject):
             'handle': self.handle
         }
 
-    def fetch(self, create=False, ssh=None):
-        query_string = urlencode(self.query)
-        results = self.server.get(f'/api/v1/{self.model_name}/?format=json&{query_string}', ssh)
-        if results:
-            self.id = results[-1]['id']
-            if 'handle' in results[-1]:
-                self.handle = results[-1]['handle']
-        elif create:
-            self.server.post(f'/api/v1/{self.model_name}/?format=json', json.dumps(self.new_json), ssh)
-            self.fetch(False, ssh)
+    def load(self, result):
+        self.id = result['id']
+        if 'handle' in result:
+            self.handle = result['handle']
 
 
 class Dataset(TardisObject):
@@ -161,11 +436,26 @@ class Dataset(TardisObject):
             "instrument": f"/api/v1/instrument/{self.instrument.id}/",
             "created_time": self.studytime
         }
+        self.lock = threading.Lock()
+        # Existing datafiles by filename, listed on first use
+        self.listing = None
 
     @property
     def uri(self):
         return f'{self.name}-{self.id}'
 
+    def datafiles(self, ssh=None):
+        """Existing datafiles of dataset by filename, listed once in pages"""
+        with self.lock:
+            if self.listing is None:
+                query_string = urlencode({'dataset__id': self.id})
+                self.listing = {
+                    x['filename']: x
+                    for x in self.server.get_pages(f'/api/v1/dataset_file/?format=json&{query_string}', ssh)
+                }
+                logging.info(f'Dataset {self.fullname} holds {len(self.listing)} datafiles')
+            return self.listing
+
 
 class StorageBox(TardisObject):
     def __init__(self, server, name):
@@ -176,15 +466,21 @@ class StorageBox(TardisObject):
     def fetch(self, create=False, ssh=None):
         if create:
             logging.warning('Storagebox creation not authorized')
-        results = self.server.get(f'/api/v1/{self.model_name}/?format=json&limit=1000', ssh)
-        if results:
-            for result in results:
-                if result['name'] == self.name:
-                    self.id = result['id']
-                    self.path = pathlib.PurePosixPath(result['options'][0]['value'])
-                    if not self.path.is_absolute():
-                        logging.error('Storage box path not absolute')
-                        raise Exception
+        if self.from_cache():
+            return
+        query_string = urlencode(self.query)
+        for result in self.server.get_pages(f'/api/v1/{self.model_name}/?format=json&{query_string}', ssh):
+            if result['name'] == self.name:
+                self.load(result)
+                self.to_cache(result)
+                break
+
+    def load(self, result):
+        self.id = result['id']
+        self.path = pathlib.PurePosixPath(result['options'][0]['value'])
+        if not self.path.is_absolute():
+            logging.error('Storage box path not absolute')
+            raise Exception
 
 
 class ObjectACL(TardisObject):
@@ -196,7 +492,7 @@ class ObjectACL(TardisObject):
         self.query = {
             'pluginId': 'django_group',
             'entityId': self.group.id,
-            'limit': 1000
+            'object_id': self.experiment.id
         }
         self.new_json = {
             "pluginId": "django_group",
@@ -213,17 +509,19 @@ class ObjectACL(TardisObject):
             "expiryDate": None}
 
     def fetch(self, create=False, ssh=None):
+        if self.from_cache():
+            return
         query_string = urlencode(self.query)
-        results = self.server.get(f'/api/v1/{self.model_name}/?format=json&{query_string}', ssh)
         result = None
-        for iresult in results:
+        # object_id is shared by all content types, so the experiment is still checked
+        for iresult in self.server.get_pages(f'/api/v1/{self.model_name}/?format=json&{query_string}', ssh):
             if iresult['content_object'] == f"/api/v1/experiment/{self.experiment.id}/":
                 result = iresult
                 break
-        #TODO use offset to loop through GET results
 
         if result:
-            self.id = result['id']
+            self.load(result)
+            self.to_cache(result)
         elif create:
             self.server.post(f'/api/v1/{self.model_name}/?format=json', json.dumps(self.new_json), ssh)
             self.fetch(False, ssh)
@@ -257,8 +555,8 @@ class Datafile(TardisObject):
             "dataset": f"/api/v1/dataset/{self.dataset.id}/",
             "filename": self.name,
             # "directory": self.study,
-            "md5sum": checksum('md5', self.file),
-            "sha512sum": checksum('sha512', self.file),
+            "md5sum": self.checksums['md5'],
+            "sha512sum": self.checksums['sha512'],
             "size": str(self.file.stat().st_size),
             "mimetype": mimetypes.guess_type(str(self.file))[0],
             "created_time": self.acqtime,
@@ -274,27 +572,39 @@ class Datafile(TardisObject):
     def uri(self):
         return f'{self.dataset.uri}/{self.name}'
 
-    def fetch(self, create=False, ssh=None, files=None):
-        self.query = {
-            'dataset__id': self.dataset.id,
-            'filename': urllib.parse.quote(self.name)
-        }
-        query_string = urlencode(self.query)
-        results = self.server.get(f'/api/v1/{self.model_name}/?format=json&{query_string}', ssh)
-        if results:
-            self.id = results[-1]['id']
-            self.md5sum = results[-1]['md5sum']
-            self.sha512sum = results[-1]['sha512sum']
-            self.verified = results[-1]['replicas'][0]['verified']
-            self.size = results[-1]['size']
-            self.directory = results[-1]['directory']
+    @property
+    def checksums(self):
+        """md5 & sha512 of file, hashed in one read and cached on file identity"""
+        return checksums(self.file)
+
+    def fetch(self, create=False, ssh=None, files=None, listed=True):
+        """Loads datafile from the server, registering it if create
+        :param listed: look datafile up in the dataset listing, which was
+            current when first used, instead of with its own GET
+        """
+        if listed:
+            result = self.dataset.datafiles(ssh).get(self.name)
+        else:
+            self.query = {
+                'dataset__id': self.dataset.id,
+                'filename': urllib.parse.quote(self.name)
+            }
+            query_string = urlencode(self.query)
+            results = self.server.get(f'/api/v1/{self.model_name}/?format=json&{query_string}', ssh)
+            result = results[-1] if results else None
+            if result:
+                with self.dataset.lock:
+                    if self.dataset.listing is not None:
+                        self.dataset.listing[self.name] = result
+        if result:
+            self.load(result)
         elif create:
             self.new_json = {
                 "dataset": f"/api/v1/dataset/{self.dataset.id}/",
                 "filename": self.name,
                 "directory": self.study,
-                "md5sum": checksum('md5', self.file),
-                "sha512sum": checksum('sha512', self.file),
+                "md5sum": self.checksums['md5'],
+                "sha512sum": self.checksums['sha512'],
                 "size": str(self.file.stat().st_size),
                 "mimetype": mimetypes.guess_type(str(self.file))[0],
                 "created_time": self.acqtime,
@@ -306,31 +616,35 @@ class Datafile(TardisObject):
                 }]
             }
             if files:
+                def stored():
+                    # A record of an upload that failed mid-content never verifies
+                    self.fetch(False, ssh, listed=False)
+                    return bool(self.verified) and self.matches()
+
                 # self.new_json["replicas"][0]["uri"] = ""
-                self.server.post(f'/api/v1/{self.model_name}/?format=json', json.dumps(self.new_json), ssh, files)
+                self.server.post(f'/api/v1/{self.model_name}/?format=json', json.dumps(self.new_json), ssh, files,
+                                 stored=stored)
             else:
                 self.server.post(f'/api/v1/{self.model_name}/?format=json', json.dumps(self.new_json), ssh)
-            self.fetch(False, ssh)
+            self.fetch(False, ssh, listed=False)
+
+    def load(self, result):
+        self.id = result['id']
+        self.md5sum = result['md5sum']
+        self.sha512sum = result['sha512sum']
+        self.verified = result['replicas'][0]['verified']
+        self.size = result['size']
+        self.directory = result['directory']
+
+    def matches(self):
+        """True if the loaded datafile holds file, by size and md5"""
+        return (self.id is not None and str(self.size) == str(self.file.stat().st_size)
+                and self.md5sum == self.checksums['md5'])
 
     def verify(self, ssh):
         self.server.get(f'/api/v1/{self.model_name}/{self.id}/verify/?format=json', ssh)
 
     def scp(self, ssh):
-        sftp = ssh.open_sftp()
         targetdir = f'{self.storagebox.path}/{self.dataset.uri}'
         targetfile = f'{targetdir}/{self.name}'
-        try:
-            sftp.chdir(str(self.storagebox.path))  # Test if remote_path exists
-        except IOError:
-            sftp.mkdir(str(self.storagebox.path))  # Create remote_path
-            sftp.chdir(str(self.storagebox.path))
-        try:
-            sftp.chdir(targetdir)  # Test if remote_path exists
-        except IOError:
-            sftp.mkdir(targetdir)  # Create remote_path
-            sftp.chdir(targetdir)
-
-        # _, stdout, _ = ssh.exec_command(f'mkdir -p {targetdir}')
-        sftp.put(str(self.file), targetfile)
-
-
+        Transfer.get(ssh).put(self.file, targetfile)
@@ -56,17 +56,135 @@ def create_tmpdir(tmproot=tempfile.gettempdir(), prefix=None):
     return tmpdir, tmphandle
 
 
-def checksum(hasher, infile, blocksize=65536):
+class WorkDir:
+    """Job work dir, removed when the job succeeds and kept after a failure for --resume"""
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+
+    def __enter__(self):
+        return self.path
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            shutil.rmtree(str(self.path), ignore_errors=True)
+        else:
+            logging.warning(f'Keeping {self.path} for --resume')
+
+
+def create_workdir(tmproot, name, key, resume=False):
+    """Creates the work dir of a job, or reuses the latest one to resume it
+    :param tmproot: Root dir to create work dir in
+    :param name: job name used as prefix
+    :param key: string identifying the job input, e.g. its input directory
+    :param resume: reuse the most recent work dir of the same job if there is one
+    :return: (work dir, WorkDir handle)
+    """
+    tmproot = pathlib.Path(tmproot).resolve()
+    tmproot.mkdir(parents=True, exist_ok=True)
+    prefix = f'imgtr-{name}-{hashlib.md5(str(key).encode()).hexdigest()[:8]}-'
+    workdirs = sorted(tmproot.glob(f'{prefix}*'), key=lambda x: x.stat().st_mtime)
+    if resume and workdirs:
+        workdir = workdirs[-1]
+        logging.info(f'Resuming from {workdir}')
+    else:
+        workdir = pathlib.Path(tempfile.mkdtemp(prefix=prefix, dir=str(tmproot))).resolve()
+        if workdirs:
+            logging.warning(f'Earlier work dirs of this job left in {tmproot}, use --resume to continue them')
+    return workdir, WorkDir(workdir)
+
+
+CHECKSUM_HASHERS = ('md5', 'sha512')
+CHECKSUM_BLOCKSIZE = 4 * 1024 * 1024
+
+# Digests of files already hashed, keyed by file identity
+_checksum_cache = {}
+
+
+def file_identity(infile):
+    """Identity of file content for checksum caching
+    :return: (resolved path, size, mtime in ns)
+    """
+    infile = pathlib.Path(infile).resolve()
+    stat = infile.stat()
+    return str(infile), stat.st_size, stat.st_mtime_ns
+
+
+def remember_checksums(identity, digests):
+    """Seeds the checksum cache with digests of a file hashed earlier
+    :param identity: (resolved path, size, mtime in ns) of file when it was hashed
+    :param digests: dict of hasher name to hash as string
+    """
+    _checksum_cache.setdefault(tuple(identity), {}).update(digests)
+
+
+def checksums(infile, hashers=CHECKSUM_HASHERS, blocksize=CHECKSUM_BLOCKSIZE):
+    """Calculates all requested checksums in a single read of the file
+    Results are cached on file identity so a file is only read once
+    :param infile: input file to be checksummed
+    :param hashers: hashlib algorithm names, defaults to md5 & sha512
+    :param blocksize: read buffer size, defaults to 4 MiB
+    :return: dict of hasher name to hash as string
+    """
+    identity = file_identity(infile)
+    digests = _checksum_cache.setdefault(identity, {})
+    missing = [x for x in hashers if x not in digests]
+    if missing:
+        hashes = [hashlib.new(x) for x in missing]
+        buf = bytearray(blocksize)
+        view = memoryview(buf)
+        with open(str(infile), 'rb') as datafile:
+            size = datafile.readinto(buf)
+            while size:
+                for hash in hashes:
+                    hash.update(view[:size])
+                size = datafile.readinto(buf)
+        digests.update((x, hash.hexdigest()) for x, hash in zip(missing, hashes))
+    return {x: digests[x] for x in hashers}
+
+
+def checksum(hasher, infile, blocksize=CHECKSUM_BLOCKSIZE):
     """Calculates checksum using supported hashing function
     :param hasher: md5 & sha512 supported
     :param infile: input file to be checksummed
-    :param blocksize: defaults to 65536
+    :param blocksize: defaults to 4 MiB
     :return: hash as string
     """
-    hashers = {'md5': hashlib.md5(), 'sha512': hashlib.sha512()}
-    with open(str(infile), 'rb') as datafile:
-        buf = datafile.read(blocksize)
-        while len(buf) > 0:
-            hashers[hasher].update(buf)
-            buf = datafile.read(blocksize)
-        return hashers[hasher].hexdigest()
+    return checksums(infile, (hasher,), blocksize)[hasher]
+
+
+class HashingWriter:
+    """Write-only file that hashes bytes on their way to disk
+    It is not seekable, so zipfile streams members with data descriptors
+    instead of seeking back and every byte is hashed exactly once. The
+    digests are added to the checksum cache when the file is closed.
+    """
+    def __init__(self, outfile, hashers=CHECKSUM_HASHERS):
+        self.outfile = pathlib.Path(outfile)
+        self.file = open(str(self.outfile), 'wb')
+        self.hashes = {x: hashlib.new(x) for x in hashers}
+        self.position = 0
+
+    def write(self, data):
+        for hash in self.hashes.values():
+            hash.update(data)
+        self.file.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            digests = {x: hash.hexdigest() for x, hash in self.hashes.items()}
+            _checksum_cache[file_identity(self.outfile)] = digests
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,247 @@
+import imgtr.dicom
+import os
+import pathlib
+import logging
+import time
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+logger = logging.getLogger(__name__)
+
+
+class Watcher:
+    """Finds files added under a directory, with inotify or by polling
+    Polling walks skip files changed before the previous walk started, so
+    only the files reported since then are tracked. An overflowing inotify
+    queue is recovered by a walk of the files changed since the last read.
+    """
+    # Seconds of filesystem timestamp granularity tolerated between polling walks
+    CLOCK_SLACK = 2
+
+    def __init__(self, indir, interval=10, inotify=True):
+        self.indir = pathlib.Path(indir)
+        self.interval = interval
+        # Files already reported, with their ctime
+        self.known = {}
+        # Files changed before were reported by an earlier polling walk, None with inotify
+        self.since = None
+        self.inotify = None
+        self.watches = {}
+        self.started = False
+        # Time the last inotify read or first walk started, events before it were read
+        self.read = None
+        if inotify and inotify_simple:
+            self.inotify = inotify_simple.INotify()
+            logging.info(f'Watching {self.indir} with inotify')
+        else:
+            logging.info(f'Watching {self.indir} by polling every {self.interval}s')
+
+    def poll(self):
+        """New files since the last poll, waits up to interval for them
+        The first poll returns all files already in indir.
+        """
+        if self.inotify is None or not self.started:
+            if self.started:
+                time.sleep(self.interval)
+            self.started = True
+            start = time.time()
+            infiles = self.walk(self.indir, self.since)
+            if self.inotify is None:
+                self.since = start - self.CLOCK_SLACK
+                self.known = {x: y for x, y in self.known.items() if y >= self.since}
+            else:
+                self.read = start
+            return infiles
+        infiles = []
+        flags = inotify_simple.flags
+        read, self.read = self.read, time.time()
+        for event in self.inotify.read(timeout=self.interval * 1000):
+            if event.mask & flags.Q_OVERFLOW:
+                logging.warning(f'Events of {self.indir} overflowed, walking it')
+                infiles.extend(self.walk(self.indir, read - self.CLOCK_SLACK))
+                continue
+            path = self.watches.get(event.wd)
+            if path is None or not event.name:
+                continue
+            path = path/event.name
+            if flags.ISDIR in flags.from_mask(event.mask):
+                # New study dirs may already hold files by the time they are watched
+                infiles.extend(self.walk(path))
+            elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                infiles.extend(self.add(path))
+        return infiles
+
+    def walk(self, indir, since=None):
+        """Files under indir not reported yet, adding inotify watches on the way
+        :param since: time before which changed files were reported already, None to walk all
+        """
+        infiles = []
+        self.watch(indir)
+        try:
+            entries = list(os.scandir(str(indir)))
+        except OSError:
+            return infiles
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                infiles.extend(self.walk(pathlib.Path(entry.path), since))
+            elif entry.is_file(follow_symlinks=False):
+                try:
+                    ctime = entry.stat(follow_symlinks=False).st_ctime
+                except OSError:
+                    continue
+                infiles.extend(self.add(pathlib.Path(entry.path), ctime, since))
+        return infiles
+
+    def watch(self, indir):
+        if self.inotify is not None and indir not in self.watches.values():
+            flags = inotify_simple.flags
+            wd = self.inotify.add_watch(str(indir), flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)
+            self.watches[wd] = indir
+
+    def add(self, infile, ctime=None, since=None):
+        if infile in self.known or (since is not None and ctime is not None and ctime < since):
+            return []
+        self.known[infile] = time.time() if ctime is None else ctime
+        return [infile]
+
+    def retry(self, infiles):
+        """Reports files again on their next event or walk"""
+        for infile in infiles:
+            self.known.pop(pathlib.Path(infile), None)
+
+    def forget(self, infiles):
+        """Stops tracking files uploaded or removed from indir
+        Files changed since the previous polling walk are kept until the next
+        walk skips them, or it would report them again.
+        """
+        for infile in infiles:
+            infile = pathlib.Path(infile)
+            ctime = self.known.get(infile)
+            if ctime is not None and (self.since is None or ctime < self.since):
+                del self.known[infile]
+
+
+class PendingSeries:
+    """Files of a series still being received
+    Files repeating a SOPInstanceUID of the series are kept apart as duplicates.
+    """
+    def __init__(self, expected=None):
+        self.files = []
+        self.duplicates = []
+        self.sops = set()
+        self.expected = expected
+        self.last_seen = time.monotonic()
+
+    def add(self, infile, sop_instance_uid=None):
+        """:return: False if infile is a duplicate instance"""
+        self.last_seen = time.monotonic()
+        if sop_instance_uid is not None:
+            if sop_instance_uid in self.sops:
+                self.duplicates.append(infile)
+                return False
+            self.sops.add(sop_instance_uid)
+        self.files.append(infile)
+        return True
+
+    def complete(self, quiet):
+        """True once the expected instance count arrived or no file arrived for quiet seconds"""
+        if self.expected and len(self.files) >= self.expected:
+            return True
+        return time.monotonic() - self.last_seen > quiet
+
+
+def scan_or_skip(infile):
+    """scanner that logs and skips files it cannot route instead of raising
+    :return: (infile, scan result or None)
+    """
+    try:
+        return infile, imgtr.dicom.scanner(infile)
+    except Exception as e:
+        logging.error(f'Cannot scan {infile}: {e!r}. Skipping ...')
+        return infile, None
+
+
+def expected_count(infile, count_tag):
+    """Number of instances of the series announced by count_tag, None if unknown or count_tag is None"""
+    if not count_tag:
+        return None
+    try:
+        dcm = imgtr.dicom.read_header(infile, [count_tag])
+        return int(getattr(dcm, count_tag))
+    except Exception:
+        return None
+
+
+def watch(job):
+    """Long-running loop uploading series as they complete in indir
+    Pools, HTTP session and SSH connection stay open between series.
+    """
+    cfg = job.cfg
+    interval = cfg.getfloat('Watch', 'interval', fallback=10)
+    quiet = cfg.getfloat('Watch', 'quiet', fallback=120)
+    count_tag = cfg.get('Watch', 'count-tag', fallback=None)
+    remove = cfg.getboolean('Watch', 'remove', fallback=False)
+    use_inotify = cfg.getboolean('Watch', 'inotify', fallback=True)
+
+    watcher = Watcher(job.indir, interval, use_inotify)
+    pools = imgtr.dicom.make_pool(job)
+    pending = {}
+    job.open_staging()
+    try:
+        while True:
+            infiles = watcher.poll()
+            start = time.perf_counter()
+            if job.cores > 1:
+                chunksize = imgtr.dicom.scan_chunksize(len(infiles), job.cores)
+                scan_results = pools.imap_unordered(scan_or_skip, infiles, chunksize)
+            else:
+                scan_results = (scan_or_skip(x) for x in infiles)
+            for infile, scan_result in scan_results:
+                if scan_result is None:
+                    # Possibly still being written, scanned again on its next event or walk
+                    watcher.retry([infile])
+                    continue
+                infile, series_json_string, sop_instance_uid, size = scan_result
+                if series_json_string not in pending:
+                    pending[series_json_string] = PendingSeries(expected_count(infile, count_tag))
+                if not pending[series_json_string].add(infile, sop_instance_uid):
+                    logging.info(f'Duplicate instance {sop_instance_uid}. Skipping ... {infile}')
+                    job.metrics.count('duplicate_files')
+                    job.metrics.count('duplicate_bytes', size)
+            if infiles:
+                job.metrics.add_stage('scan', time.perf_counter() - start, len(infiles))
+
+            complete = {x: pending.pop(x) for x in [x for x, y in pending.items() if y.complete(quiet)]}
+            if not complete:
+                continue
+            logging.info(f'{len(complete)} series complete, {len(pending)} still receiving')
+            try:
+                results = imgtr.dicom.process_series(job, ((x, y.files) for x, y in complete.items()), pools)
+            except Exception as e:
+                logging.error(f'Processing series failed: {e!r}')
+                results = [(None, e)] * len(complete)
+            for (series_json_string, series), (serieszip, error) in zip(complete.items(), results):
+                if serieszip:
+                    pathlib.Path(serieszip).unlink()
+                if error:
+                    # Retried once the series has been quiet again
+                    logging.error(f'Series will be retried: {series_json_string}')
+                    retry = pending.setdefault(series_json_string, PendingSeries(series.expected))
+                    retry.files = series.files + retry.files
+                    retry.duplicates = series.duplicates + retry.duplicates
+                    retry.sops |= series.sops
+                else:
+                    if remove:
+                        for infile in series.files + series.duplicates:
+                            pathlib.Path(infile).unlink()
+                    watcher.forget(series.files + series.duplicates)
+            job.write_metrics()
+    except KeyboardInterrupt:
+        logging.info('Stopping watch')
+    finally:
+        job.staging.close()
+        pools.close()
+        pools.join()
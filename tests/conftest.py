@@ -0,0 +1,41 @@
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import pytest
+import threading
+
+
+@pytest.fixture
+def http_status():
+    """Starts HTTP servers answering every request with status
+    :return: callable of status returning (url, count of requests by method)
+    """
+    servers = []
+
+    def start(status):
+        counts = {'GET': 0, 'POST': 0}
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self):
+                counts[self.command] += 1
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            do_GET = reply
+            do_POST = reply
+
+        httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        servers.append(httpd)
+        return 'http://%s:%s' % httpd.server_address, counts
+
+    yield start
+    for httpd in servers:
+        httpd.shutdown()
+        httpd.server_close()
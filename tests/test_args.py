@@ -0,0 +1,24 @@
+from imgtr.imgtr import get_args
+import pytest
+
+
+def test_options_between_datatype_and_indir():
+    args = get_args(['dicom', '--cores', '2', '/data/session'])
+    assert args.datatype == 'dicom'
+    assert args.cores == '2'
+    assert args.indir == ['/data/session']
+
+
+def test_batch_of_input_dirs(tmp_path):
+    batch = tmp_path/'batch.txt'
+    batch.write_text('# sessions\n/data/b\n\n/data/c\n')
+    args = get_args(['dicom', '/data/a', '--resume', '--batch', str(batch)])
+    assert args.indir == ['/data/a', '/data/b', '/data/c']
+    assert args.resume
+
+
+def test_watch_takes_one_input_dir():
+    with pytest.raises(SystemExit):
+        get_args(['dicom', '--watch', '/data/a', '/data/b'])
+    with pytest.raises(SystemExit):
+        get_args(['dicom', '--cores', '2'])
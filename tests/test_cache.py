@@ -0,0 +1,36 @@
+from imgtr.cache import ObjectCache
+from imgtr.tardis import Experiment
+from imgtr.tardis import Group
+from imgtr.tardis import TardisServer
+import json
+
+
+def test_expired_results_are_misses(tmp_path):
+    cache = ObjectCache(tmp_path/'cache.db', ttl=60)
+    cache.set('url', 'facility', 'name=MRI', {'id': 1})
+    assert cache.get('url', 'facility', 'name=MRI') == {'id': 1}
+    cache.ttl = -1
+    assert cache.get('url', 'facility', 'name=MRI') is None
+    cache.ttl = 60
+    assert cache.get('url', 'facility', 'name=MRI') is None
+    cache.close()
+
+
+def test_failed_request_invalidates_referenced_cached_object_only(http_status, tmp_path):
+    missing, _ = http_status(404)
+    cache = ObjectCache(tmp_path/'cache.db')
+    server = TardisServer(missing, 'user', 'key', 'institution', cache=cache)
+    group = Group(server, 'MRI')
+    experiment = Experiment(server, 'project')
+    cache.set(missing, group.model_name, group.cache_key, {'id': 3, 'name': 'MRI'})
+    cache.set(missing, experiment.model_name, experiment.cache_key, {'id': 7})
+    assert group.from_cache() and experiment.from_cache()
+
+    # A failure that references no cached ID keeps the cache
+    server.post('/api/v1/dataset/', json.dumps({'experiments': ['/api/v1/experiment/8/']}))
+    assert cache.get(missing, experiment.model_name, experiment.cache_key) == {'id': 7}
+
+    server.post('/api/v1/dataset/', json.dumps({'experiments': ['/api/v1/experiment/7/']}))
+    assert cache.get(missing, experiment.model_name, experiment.cache_key) is None
+    assert cache.get(missing, group.model_name, group.cache_key) == {'id': 3, 'name': 'MRI'}
+    server.close()
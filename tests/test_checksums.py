@@ -0,0 +1,39 @@
+from imgtr import utils
+import hashlib
+import os
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def checksum_cache(monkeypatch):
+    monkeypatch.setattr(utils, '_checksum_cache', {})
+
+
+def test_checksums_are_cached_on_file_identity(tmp_path):
+    infile = tmp_path/'series.zip'
+    infile.write_bytes(b'a' * 1000)
+    assert utils.checksum('md5', infile, blocksize=64) == hashlib.md5(b'a' * 1000).hexdigest()
+    assert utils.checksums(infile)['sha512'] == hashlib.sha512(b'a' * 1000).hexdigest()
+    assert len(utils._checksum_cache) == 1
+
+    # Same size, new content and mtime
+    infile.write_bytes(b'b' * 1000)
+    stat = infile.stat()
+    os.utime(infile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert utils.checksum('md5', infile) == hashlib.md5(b'b' * 1000).hexdigest()
+
+
+def test_hashing_writer_seeds_the_cache(tmp_path, monkeypatch):
+    outfile = tmp_path/'series.zip'
+    with utils.HashingWriter(outfile) as writer:
+        writer.write(b'abc')
+        writer.write(b'def')
+    assert writer.tell() == 6
+
+    def unread(*args, **kwargs):
+        raise AssertionError('cached file read again')
+    monkeypatch.setattr(utils, 'open', unread, raising=False)
+    assert utils.checksums(outfile) == {
+        'md5': hashlib.md5(b'abcdef').hexdigest(),
+        'sha512': hashlib.sha512(b'abcdef').hexdigest()
+    }
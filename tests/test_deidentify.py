@@ -0,0 +1,70 @@
+from imgtr.dicom import sorter
+from pydicom.dataset import Dataset
+from pydicom.dataset import FileDataset
+from pydicom.dataset import FileMetaDataset
+import io
+import json
+import pydicom
+import pydicom.uid
+import pytest
+
+SERIES_JSON = json.dumps({'experiment': 'project', 'dataset': 'subject'})
+
+
+def make_dicom(path, transfer_syntax):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = pydicom.uid.MRImageStorage
+    meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    meta.TransferSyntaxUID = transfer_syntax
+    dcm = FileDataset(str(path), Dataset(), file_meta=meta, preamble=b'\0' * 128)
+    dcm.is_little_endian = transfer_syntax != pydicom.uid.ExplicitVRBigEndian
+    dcm.is_implicit_VR = transfer_syntax == pydicom.uid.ImplicitVRLittleEndian
+    dcm.SOPClassUID = meta.MediaStorageSOPClassUID
+    dcm.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    dcm.AccessionNumber = '12345'
+    dcm.ReferringPhysicianName = 'Doe^Jane'
+    dcm.PatientName = 'Doe^John'
+    dcm.PatientID = 'MRN0001'
+    dcm.PatientBirthDate = '19700101'
+    dcm.InstanceNumber = 7
+    dcm.Rows = 16
+    dcm.Columns = 16
+    dcm.BitsAllocated = 16
+    dcm.BitsStored = 12
+    dcm.HighBit = 11
+    dcm.PixelRepresentation = 0
+    dcm.SamplesPerPixel = 1
+    dcm.PhotometricInterpretation = 'MONOCHROME2'
+    dcm.PixelData = bytes(range(256)) * 2
+    dcm.DataSetTrailingPadding = b'\0' * 4
+    dcm.save_as(str(path), write_like_original=False)
+
+
+@pytest.mark.parametrize('transfer_syntax', [
+    pydicom.uid.ExplicitVRLittleEndian,
+    pydicom.uid.ImplicitVRLittleEndian,
+    pydicom.uid.ExplicitVRBigEndian,
+    pydicom.uid.DeflatedExplicitVRLittleEndian,
+])
+def test_header_rewrite_matches_full_rewrite(tmp_path, transfer_syntax):
+    infile = tmp_path/'in.dcm'
+    make_dicom(infile, transfer_syntax)
+    name, header, _, offset, syntax = sorter(infile, SERIES_JSON)
+    assert name == '00000007.dcm'
+    assert syntax == transfer_syntax
+    member = header if offset is None else header + infile.read_bytes()[offset:]
+
+    # The same de-identified header applied to the whole dicom
+    deidentified = pydicom.dcmread(io.BytesIO(header), stop_before_pixels=True)
+    expected = pydicom.dcmread(str(infile))
+    for element in deidentified:
+        expected[element.tag] = element
+    buffer = io.BytesIO()
+    expected.save_as(buffer)
+    assert member == buffer.getvalue()
+
+    dcm = pydicom.dcmread(io.BytesIO(member))
+    assert dcm.PatientName == 'subject' and dcm.PatientID == 'subject'
+    assert dcm.ReferringPhysicianName == 'project'
+    assert dcm.AccessionNumber == '' and dcm.PatientBirthDate == ''
+    assert dcm.PixelData == bytes(range(256)) * 2
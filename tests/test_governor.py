@@ -0,0 +1,75 @@
+from imgtr.governor import Concurrency
+from imgtr.governor import Governor
+from imgtr.governor import TokenBucket
+from imgtr.governor import Window
+import datetime
+import pytest
+import time
+
+
+def test_token_bucket_paces_to_rate():
+    bucket = TokenBucket(rate=100, burst=10)
+    start = time.monotonic()
+    for _ in range(30):
+        bucket.take()
+    # The burst is empty at first, so 30 tokens take about 0.3s
+    assert time.monotonic() - start == pytest.approx(0.3, abs=0.1)
+
+
+def test_token_bucket_larger_than_burst_waits_on_credit():
+    bucket = TokenBucket(rate=1000, burst=10)
+    assert bucket.take(100) == pytest.approx(0.1, abs=0.02)
+
+
+def test_unlimited_token_bucket_never_waits():
+    assert TokenBucket().take(10 ** 9) == 0.0
+
+
+def test_concurrency_halves_on_overload_and_grows_additively(monkeypatch):
+    monkeypatch.setattr(Concurrency, 'COOLDOWN', 0)
+    concurrency = Concurrency(maximum=8, latency=1.0)
+    concurrency.acquire()
+    concurrency.release(0.1, 503)
+    assert concurrency.limit == 4
+    concurrency.acquire()
+    concurrency.release(2.0, 200)
+    assert concurrency.limit == 2
+    concurrency.acquire()
+    concurrency.release(None, None)
+    assert concurrency.limit == 1
+    for _ in range(3):
+        concurrency.acquire()
+        concurrency.release(0.1, 200)
+    # One per limit requests: 1, then 1/2, then 1/2.5
+    assert concurrency.limit == pytest.approx(2.9)
+    assert concurrency.active == 0
+
+
+def test_concurrency_decreases_once_per_cooldown():
+    concurrency = Concurrency(maximum=8)
+    for _ in range(4):
+        concurrency.acquire()
+    for _ in range(4):
+        concurrency.release(0.1, 429)
+    assert concurrency.limit == 4
+
+
+def test_overnight_window():
+    window = Window('22:00', '06:00', {'rate': 0})
+    assert window.contains(datetime.datetime(2020, 1, 1, 23, 0))
+    assert window.contains(datetime.datetime(2020, 1, 2, 5, 59))
+    assert not window.contains(datetime.datetime(2020, 1, 2, 6, 0))
+    assert not window.contains(datetime.datetime(2020, 1, 1, 12, 0))
+    day = Window('08:00', '18:00', {})
+    assert day.contains(datetime.datetime(2020, 1, 1, 8, 0))
+    assert not day.contains(datetime.datetime(2020, 1, 1, 18, 0))
+
+
+def test_window_limits_override_defaults():
+    now = datetime.datetime.now()
+    start = (now - datetime.timedelta(minutes=5)).strftime('%H:%M')
+    end = (now + datetime.timedelta(minutes=5)).strftime('%H:%M')
+    governor = Governor({'rate': 1000, 'requests': 5}, [Window(start, end, {'rate': 0})])
+    assert governor.window is not None
+    assert governor.bytes.rate is None
+    assert governor.requests.rate == 5
@@ -0,0 +1,41 @@
+from benchmarks.fakes import FakeTardis
+from concurrent.futures import ThreadPoolExecutor
+from imgtr.dicom import Hierarchies
+from imgtr.tardis import TardisServer
+import configparser
+import pytest
+
+
+@pytest.fixture
+def tardis(tmp_path):
+    # Latency widens the window in which concurrent lookups of an object overlap
+    tardis = FakeTardis(latency=0.02, storagebox=tmp_path).start()
+    yield tardis
+    tardis.stop()
+
+
+def test_concurrent_datasets_share_objects_above_them(tardis):
+    cfg = configparser.ConfigParser()
+    cfg['Prisma'] = {'storagebox': 'default'}
+    server = TardisServer(tardis.url, 'user', 'key', 'institution')
+    hierarchies = Hierarchies(server, cfg)
+    series = [
+        {'instrument': 'Prisma', 'facility': 'MRI', 'experiment': f'project{x % 2}', 'dataset': f'subject{x}',
+         'study': 'study'}
+        for x in range(4)
+        for _ in range(2)
+    ]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        datasets = list(executor.map(lambda x: hierarchies.get(x, '2020-01-01T10:10:10')[1], series))
+    server.close()
+
+    objects = {x: len(y) for x, y in tardis.objects.items()}
+    # Facility manager group and one group per experiment
+    assert objects['group'] == 3
+    assert objects['facility'] == 1
+    assert objects['instrument'] == 1
+    assert objects['experiment'] == 2
+    assert objects['dataset'] == 4
+    assert objects['objectacl'] == 4
+    # Series of a dataset share its object and listing
+    assert len({id(x) for x in datasets}) == 4
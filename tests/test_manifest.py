@@ -0,0 +1,33 @@
+from imgtr.manifest import Manifest
+
+
+def test_scan_keeps_lowest_path_of_each_instance_across_batches(tmp_path):
+    manifest = Manifest(tmp_path/'manifest.sqlite')
+    results = [
+        ('/in/b/1.dcm', 'series1', '1.1', 100),
+        ('/in/c/2.dcm', 'series1', '1.2', 100),
+        ('/in/a/1.dcm', 'series1', '1.1', 100),
+        ('/in/d/1.dcm', 'series2', '1.1', 100),
+        # Files without SOPInstanceUID are all kept
+        ('/in/e/1.dcm', 'series3', None, 10),
+        ('/in/e/2.dcm', 'series3', None, 10),
+    ]
+    assert manifest.add_scan(results, batch=2) == 6
+    assert manifest.scanned
+    assert manifest.files('series1') == ['/in/a/1.dcm', '/in/c/2.dcm']
+    # series2 only held a duplicate of series1
+    assert manifest.series() == ['series1', 'series3']
+    assert manifest.duplicates() == (2, 200)
+    manifest.close()
+
+
+def test_rescan_replaces_previous_scan(tmp_path):
+    manifest = Manifest(tmp_path/'manifest.sqlite')
+    manifest.add_scan([('/in/1.dcm', 'series1', '1.1', 100)])
+    manifest.update('series1', 'zipped', zip='series1.zip')
+    assert manifest.reached('series1', 'sorted')
+    manifest.add_scan([('/in/1.dcm', 'series1', '1.1', 100), ('/in/2.dcm', 'series1', '1.1', 100)])
+    assert manifest.files('series1') == ['/in/1.dcm']
+    assert not manifest.reached('series1', 'sorted')
+    assert manifest.duplicates() == (1, 100)
+    manifest.close()
@@ -0,0 +1,35 @@
+from concurrent.futures import ThreadPoolExecutor
+import imgtr.profiling
+import pytest
+import threading
+
+
+@pytest.fixture
+def profiling(tmp_path, monkeypatch):
+    monkeypatch.setattr(imgtr.profiling, '_profiles', {})
+    imgtr.profiling.start(tmp_path)
+    yield tmp_path
+    imgtr.profiling.dump()
+    monkeypatch.setattr(imgtr.profiling, '_profile_dir', None)
+
+
+@imgtr.profiling.profiled('push')
+def push(barrier):
+    # Every thread is inside the stage at the same time
+    barrier.wait()
+    return sum(x * x for x in range(10000))
+
+
+def test_overlapping_stages_of_threads(profiling):
+    barrier = threading.Barrier(4)
+    with imgtr.profiling.stage('zip'), ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(push, [barrier] * 4))
+    assert len(set(results)) == 1
+    imgtr.profiling.dump()
+    imgtr.profiling.report(profiling)
+    assert (profiling/'profile.prof').exists()
+    assert not list(profiling.glob('*.pstats'))
+    if imgtr.profiling.PROCESS_PROFILE:
+        assert (profiling/f'{imgtr.profiling.PROCESS_STAGE}.txt').exists()
+    else:
+        assert (profiling/'zip.txt').exists() and (profiling/'push.txt').exists()
@@ -0,0 +1,51 @@
+from benchmarks.fakes import FakeTardis
+from imgtr.dicom import Hierarchies
+from imgtr.staging import upload_file
+from imgtr.tardis import Datafile
+from imgtr.tardis import TardisServer
+import configparser
+import hashlib
+import pytest
+
+
+@pytest.fixture
+def tardis(tmp_path):
+    tardis = FakeTardis(storagebox=tmp_path).start()
+    yield tardis
+    tardis.stop()
+
+
+def datafile(tardis, serieszip, md5):
+    """Datafile of serieszip, registered unverified with md5 by an earlier run"""
+    cfg = configparser.ConfigParser()
+    cfg['Prisma'] = {'storagebox': 'default'}
+    server = TardisServer(tardis.url, 'user', 'key', 'institution')
+    series_json = {'instrument': 'Prisma', 'facility': 'MRI', 'experiment': 'project', 'dataset': 'subject',
+                   'study': 'study'}
+    storagebox, dataset = Hierarchies(server, cfg).get(series_json, '2020-01-01T10:10:10')
+    tardis.create('dataset_file', {
+        'dataset': f'/api/v1/dataset/{dataset.id}/', 'filename': serieszip.name, 'directory': 'study',
+        'md5sum': md5, 'sha512sum': '', 'size': str(serieszip.stat().st_size), 'replicas': [{'verified': False}]
+    })
+    return Datafile(server, serieszip, storagebox, dataset, 'study', '2020-01-01T10:10:10', '2020-01-01T10:10:10')
+
+
+def test_transferred_series_is_only_verified(tardis, tmp_path):
+    serieszip = tmp_path/'0001_series.zip'
+    serieszip.write_bytes(b'zip' * 100)
+    stages = []
+    upload = datafile(tardis, serieszip, hashlib.md5(serieszip.read_bytes()).hexdigest())
+    posts = tardis.requests['POST']
+    upload_file(upload, None, stages.append, transferred=True)
+    upload.server.close()
+    assert tardis.requests['POST'] == posts
+    assert stages == ['verified']
+    assert tardis.objects['dataset_file'][0]['replicas'][0]['verified']
+
+
+def test_transferred_series_of_other_content_is_sent_again(tardis, tmp_path):
+    serieszip = tmp_path/'0001_series.zip'
+    serieszip.write_bytes(b'zip' * 100)
+    upload = datafile(tardis, serieszip, 'stale')
+    assert not upload.fetch() and not upload.matches()
+    upload.server.close()
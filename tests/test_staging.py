@@ -0,0 +1,38 @@
+from imgtr.staging import Staging
+import paramiko
+import pytest
+import requests
+
+
+class Connections(Staging):
+    """Staging pooling fake connections, healthy until closed"""
+    def __init__(self):
+        Staging.__init__(self, 'user', 'host', 22, 'key')
+        self.opened = []
+
+    def connect(self):
+        self.opened.append(object())
+        return self.opened[-1]
+
+    def disconnect(self, ssh):
+        self.opened.remove(ssh)
+
+    @staticmethod
+    def healthy(ssh):
+        return ssh is not None
+
+
+def test_http_errors_keep_the_connection():
+    staging = Connections()
+    staging.open()
+    with pytest.raises(requests.HTTPError):
+        with staging.connection() as ssh:
+            raise requests.HTTPError('503 Server Error')
+    with staging.connection() as again:
+        assert again is ssh
+    with pytest.raises(paramiko.SSHException):
+        with staging.connection() as ssh:
+            raise paramiko.SSHException('Channel closed')
+    assert staging.opened == []
+    with staging.connection() as again:
+        assert again is not ssh
@@ -0,0 +1,144 @@
+from benchmarks.fakes import FakeStaging
+from imgtr.staging import Transfer
+import logging
+import os
+import paramiko
+import pytest
+import threading
+
+
+@pytest.fixture
+def staging():
+    staging = FakeStaging().start()
+    yield staging
+    staging.stop()
+
+
+@pytest.fixture
+def ssh(staging, tmp_path):
+    key = tmp_path/'key'
+    paramiko.RSAKey.generate(2048).write_private_key_file(str(key))
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(hostname='127.0.0.1', port=staging.port, username='test', key_filename=str(key))
+    yield ssh
+    ssh.close()
+
+
+@pytest.fixture
+def localfile(tmp_path):
+    localfile = tmp_path/'series.zip'
+    localfile.write_bytes(os.urandom(3 * 1024 * 1024 + 123))
+    return localfile
+
+
+def transfer(ssh):
+    transfer = Transfer(ssh, streams=4, split_size=1024 * 1024)
+    transfer.CHECKPOINT = 256 * 1024
+    return transfer
+
+
+def test_ranges_in_concurrent_sftp_sessions(ssh, localfile, tmp_path, caplog):
+    remotefile = tmp_path/'remote'/'series.zip'
+    engine = transfer(ssh)
+    with caplog.at_level(logging.WARNING):
+        engine.put(localfile, remotefile)
+    engine.close()
+    assert remotefile.read_bytes() == localfile.read_bytes()
+    assert 'Resuming' not in caplog.text
+
+
+class FaultyStaging(FakeStaging):
+    """FakeStaging whose handles pass every write through fault(offset, data)
+    fault returns an SFTP status to fail the write with, or the data to write
+    """
+    def __init__(self, fault):
+        FakeStaging.__init__(self)
+        self.fault = fault
+
+    def sftp_interface(self):
+        interface = FakeStaging.sftp_interface(self)
+        fault = self.fault
+
+        class Interface(interface):
+            def open(self, path, flags, attr):
+                handle = interface.open(self, path, flags, attr)
+                if isinstance(handle, int):
+                    return handle
+                write = handle.write
+
+                def faulty(offset, data):
+                    result = fault(offset, data)
+                    if isinstance(result, int):
+                        return result
+                    return write(offset, result)
+                handle.write = faulty
+                return handle
+
+        return Interface
+
+
+def faulty_ssh(fault, tmp_path):
+    staging = FaultyStaging(fault).start()
+    key = tmp_path/'key'
+    paramiko.RSAKey.generate(2048).write_private_key_file(str(key))
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(hostname='127.0.0.1', port=staging.port, username='test', key_filename=str(key))
+    return staging, ssh
+
+
+def test_failed_write_resumes_range(localfile, tmp_path, caplog):
+    failed = []
+
+    def fault(offset, data):
+        # The first write past 2 MiB fails once
+        if offset >= 2 * 1024 * 1024 and not failed:
+            failed.append(offset)
+            return paramiko.SFTP_FAILURE
+        return data
+
+    staging, ssh = faulty_ssh(fault, tmp_path)
+    remotefile = tmp_path/'series.remote'
+    engine = transfer(ssh)
+    with caplog.at_level(logging.WARNING):
+        engine.put(localfile, remotefile)
+    engine.close()
+    ssh.close()
+    staging.stop()
+    assert failed
+    assert 'Resuming' in caplog.text
+    assert remotefile.read_bytes() == localfile.read_bytes()
+
+
+def test_failing_writes_raise(localfile, tmp_path):
+    staging, ssh = faulty_ssh(lambda offset, data: paramiko.SFTP_FAILURE if offset else data, tmp_path)
+    engine = transfer(ssh)
+    with pytest.raises(IOError):
+        engine.put(localfile, tmp_path/'series.remote')
+    engine.close()
+    ssh.close()
+    staging.stop()
+
+
+def test_short_remote_file_raises(localfile, tmp_path):
+    size = localfile.stat().st_size
+    # The server acknowledges the last bytes of the file without storing them
+    staging, ssh = faulty_ssh(lambda offset, data: data[:max(0, size - 100 - offset)], tmp_path)
+    engine = transfer(ssh)
+    with pytest.raises(IOError, match='expected'):
+        engine.put(localfile, tmp_path/'series.remote')
+    engine.close()
+    ssh.close()
+    staging.stop()
+
+
+def test_short_lived_caller_threads_share_writer_sessions(ssh, localfile, tmp_path):
+    engine = transfer(ssh)
+    for x in range(6):
+        thread = threading.Thread(target=engine.put, args=(localfile, tmp_path/'remote'/f'{x}.zip'))
+        thread.start()
+        thread.join()
+    assert len(engine.sessions) <= engine.streams
+    engine.close()
+    assert (tmp_path/'remote'/'5.zip').read_bytes() == localfile.read_bytes()
@@ -0,0 +1,20 @@
+from imgtr.tardis import TunnelAdapter
+import socket
+import urllib3
+
+
+def test_tunnelled_connections_keep_socket_options():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    adapter = TunnelAdapter(listener.getsockname())
+    pool = adapter.poolmanager.connection_from_url('http://mytardis.example.org/')
+    connection = pool._new_conn()
+    sock = connection._new_conn()
+    try:
+        assert sock.getpeername() == listener.getsockname()
+        assert (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) in urllib3.connection.HTTPConnection.default_socket_options
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+    finally:
+        sock.close()
+        listener.close()
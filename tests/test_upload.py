@@ -0,0 +1,60 @@
+from benchmarks.fakes import FakeTardis
+from imgtr.dicom import Hierarchies
+from imgtr.tardis import Datafile
+from imgtr.tardis import TardisServer
+from urllib3.exceptions import ConnectTimeoutError
+from urllib3.exceptions import MaxRetryError
+import configparser
+import pytest
+import requests
+
+
+def test_upload_attempts_are_bounded_by_retries(http_status, tmp_path):
+    url, counts = http_status(503)
+    upload = tmp_path/'series.zip'
+    upload.write_bytes(b'zip' * 1000)
+    server = TardisServer(url, 'user', 'key', 'institution', retries=2, backoff=0.01)
+    with pytest.raises(requests.HTTPError):
+        server.post('/api/v1/dataset_file/', '{}', files=str(upload))
+    assert counts['POST'] == 3
+    server.get_json('/api/v1/dataset/')
+    assert counts['GET'] == 3
+    server.close()
+
+
+def test_adapter_retries_connect_errors_of_get_only():
+    server = TardisServer('http://127.0.0.1:9', 'user', 'key', 'institution', retries=2)
+    retry = server.session.get_adapter('http://127.0.0.1:9').max_retries
+    assert retry.increment('GET', '/', error=ConnectTimeoutError()).total == 1
+    with pytest.raises(MaxRetryError):
+        retry.increment('POST', '/', error=ConnectTimeoutError())
+    server.close()
+
+
+class DroppingTardis(FakeTardis):
+    """FakeTardis recording the first uploaded datafile truncated, then dropping the connection"""
+    def create(self, model, data, attached=None):
+        if attached is not None and not self.requests.get('dropped'):
+            self.requests['dropped'] = 1
+            FakeTardis.create(self, model, data, attached[:len(attached) // 2])
+            raise ConnectionResetError
+        return FakeTardis.create(self, model, data, attached)
+
+
+def test_upload_recorded_unverified_is_sent_again(tmp_path):
+    tardis = DroppingTardis(storagebox=tmp_path).start()
+    cfg = configparser.ConfigParser()
+    cfg['Prisma'] = {'storagebox': 'default'}
+    server = TardisServer(tardis.url, 'user', 'key', 'institution', backoff=0.01)
+    series_json = {'instrument': 'Prisma', 'facility': 'MRI', 'experiment': 'project', 'dataset': 'subject',
+                   'study': 'study'}
+    storagebox, dataset = Hierarchies(server, cfg).get(series_json, '2020-01-01T10:10:10')
+    serieszip = tmp_path/'0001_series.zip'
+    serieszip.write_bytes(b'zip' * 1000)
+    upload = Datafile(server, serieszip, storagebox, dataset, 'study', '2020-01-01T10:10:10', '2020-01-01T10:10:10')
+    posts = tardis.requests['POST']
+    upload.fetch(create=True, files=serieszip)
+    server.close()
+    tardis.stop()
+    assert tardis.requests['POST'] - posts == 2
+    assert upload.verified
@@ -0,0 +1,68 @@
+from imgtr.watch import PendingSeries
+from imgtr.watch import Watcher
+from imgtr.watch import expected_count
+from imgtr.watch import inotify_simple
+import pytest
+import time
+
+
+def test_polling_reports_each_file_once_and_prunes_known(tmp_path, monkeypatch):
+    monkeypatch.setattr(Watcher, 'CLOCK_SLACK', 0.01)
+    (tmp_path/'study').mkdir()
+    old = [tmp_path/'study'/f'{x}.dcm' for x in range(3)]
+    for infile in old:
+        infile.write_bytes(b'')
+    time.sleep(0.05)
+    watcher = Watcher(tmp_path, interval=0, inotify=False)
+    assert sorted(watcher.poll()) == old
+    watcher.forget(old)
+    time.sleep(0.05)
+    new = tmp_path/'study'/'3.dcm'
+    new.write_bytes(b'')
+    assert watcher.poll() == [new]
+    # Files older than the previous walk are skipped without being tracked
+    assert watcher.poll() == []
+    assert set(watcher.known) <= {new}
+
+
+def test_series_complete_after_quiet_without_count_tag(tmp_path):
+    assert expected_count(tmp_path/'missing.dcm', None) is None
+    series = PendingSeries(expected_count(tmp_path/'missing.dcm', None))
+    series.add('1.dcm', '1.2.3')
+    assert not series.add('1-copy.dcm', '1.2.3')
+    assert not series.complete(quiet=60)
+    series.last_seen -= 61
+    assert series.complete(quiet=60)
+
+
+@pytest.mark.skipif(inotify_simple is None, reason='needs inotify_simple')
+def test_file_failing_its_scan_is_reported_again_on_close(tmp_path):
+    watcher = Watcher(tmp_path, interval=0.1)
+    assert watcher.poll() == []
+    (tmp_path/'study').mkdir()
+    infile = tmp_path/'study'/'1.dcm'
+    # Walk of the new study dir while the file is still being copied
+    infile.write_bytes(b'DI')
+    assert watcher.poll() == [infile]
+    watcher.retry([infile])
+    with open(infile, 'ab') as fp:
+        fp.write(b'CM')
+    assert watcher.poll() == [infile]
+
+
+@pytest.mark.skipif(inotify_simple is None, reason='needs inotify_simple')
+def test_overflowed_events_are_recovered_by_a_walk(tmp_path, monkeypatch):
+    monkeypatch.setattr(Watcher, 'CLOCK_SLACK', 0.01)
+    old = tmp_path/'old.dcm'
+    old.write_bytes(b'')
+    watcher = Watcher(tmp_path, interval=0.1)
+    assert watcher.poll() == [old]
+    watcher.forget([old])
+    time.sleep(0.05)
+    assert watcher.poll() == []
+    new = tmp_path/'new.dcm'
+    new.write_bytes(b'')
+    overflow = inotify_simple.Event(-1, inotify_simple.flags.Q_OVERFLOW, 0, '')
+    monkeypatch.setattr(watcher.inotify, 'read', lambda timeout: [overflow])
+    # The uploaded file is not reported again
+    assert watcher.poll() == [new]
@@ -0,0 +1,41 @@
+from imgtr.dicom import Member
+from imgtr.dicom import write_member
+from imgtr.dicom import write_packed
+from imgtr.dicom import zip_compression
+import pytest
+import zipfile
+import zlib
+
+
+def test_members_share_attributes_however_written(tmp_path):
+    data = b'DICM' * 1000
+    infile = tmp_path/'pixels'
+    infile.write_bytes(b'\0' * 10 + data)
+    compressor = zlib.compressobj(-1, zlib.DEFLATED, -15)
+    packed = compressor.compress(data) + compressor.flush()
+    serieszip = tmp_path/'series.zip'
+    with zipfile.ZipFile(serieszip, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        write_member(zip_file, Member('header', zipfile.ZIP_DEFLATED, data, None, len(data), None, None))
+        write_member(zip_file, Member('stream', zipfile.ZIP_DEFLATED, b'', None, len(data), infile, 10))
+        write_member(zip_file, Member('stored', zipfile.ZIP_STORED, b'', None, len(data), infile, 10))
+        write_packed(zip_file, Member('packed', zipfile.ZIP_DEFLATED, packed, zlib.crc32(data), len(data), None, None))
+    with zipfile.ZipFile(serieszip) as zip_file:
+        assert zip_file.testzip() is None
+        assert {zip_file.read(x) for x in zip_file.namelist()} == {data}
+        assert {x.external_attr for x in zip_file.infolist()} == {0o600 << 16}
+        assert zip_file.getinfo('stored').compress_type == zipfile.ZIP_STORED
+
+
+@pytest.mark.parametrize('transfer_syntax, compress_type', [
+    ('1.2.840.10008.1.2.1', zipfile.ZIP_DEFLATED),
+    ('1.2.840.10008.1.2', zipfile.ZIP_DEFLATED),
+    ('1.2.840.10008.1.2.4.50', zipfile.ZIP_STORED),
+    ('1.2.840.10008.1.2.4.201', zipfile.ZIP_STORED),
+    ('1.2.840.10008.1.2.1.99', zipfile.ZIP_STORED),
+    # Private Philips transfer syntax
+    ('1.3.46.670589.33.1.4.1', zipfile.ZIP_DEFLATED),
+    (None, zipfile.ZIP_DEFLATED),
+])
+def test_zip_compression_of_transfer_syntaxes(transfer_syntax, compress_type):
+    assert zip_compression(transfer_syntax) == compress_type
+    assert zip_compression(transfer_syntax, level=0) == zipfile.ZIP_STORED